@@ -28,13 +28,13 @@ class BiliApi(object):
         else:
             self._bili_jct = ''
 
-        self._name = ret["data"]["uname"]
-        self._uid = ret["data"]["mid"]
-        self._vip = ret["data"]["vipType"]
-        self._level = ret["data"]["level_info"]["current_level"]
-        self._verified = ret["data"]["mobile_verified"]
-        self._coin = ret["data"]["money"]
-        self._exp = ret["data"]["level_info"]["current_exp"]
+        self._name = data["data"]["uname"]
+        self._uid = data["data"]["mid"]
+        self._vip = data["data"]["vipType"]
+        self._level = data["data"]["level_info"]["current_level"]
+        self._verified = data["data"]["mobile_verified"]
+        self._coin = data["data"]["money"]
+        self._exp = data["data"]["level_info"]["current_exp"]
 
         code = self.likeCv(7793107)["code"]
         if code != 0 and code != 65006 and code != -404:
@@ -603,11 +603,14 @@ class BiliApi(object):
         return self._session.post(f'{url}?uploads&output=json', headers={"X-Upos-Auth": auth}).json()
 
     def videoUpload(self, url, auth, upload_id, data, chunk, chunks, start, total):
-        "上传视频分块"
+        "上传视频分块，成功返回True，服务器返回4xx或5xx时抛出requests.HTTPError，其他返回内容返回False"
         size = len(data)
         end = start + size
         content = self._session.put(f'{url}?partNumber={chunk+1}&uploadId={upload_id}&chunk={chunk}&chunks={chunks}&size={size}&start={start}&end={end}&total={total}', data=data, headers={"X-Upos-Auth": auth})
-        return True if content.text == "MULTIPART_PUT_SUCCESS" else False
+        if content.text == "MULTIPART_PUT_SUCCESS":
+            return True
+        content.raise_for_status()
+        return False
 
     def videoUploadInfo(self, url, auth, parts, filename, upload_id, biz_id):
         "查询上传视频信息"
@@ -973,14 +976,16 @@ class BiliApi(object):
         #{'code': -10403, 'message': '大会员专享限制'}
         return self._session.get(url, params=data).json()
 
-    def playerUrl(self, cid: int, aid=0, bvid='', qn=16, reverse_proxy=''):
-        "获取视频播放地址"
+    def playerUrl(self, cid: int, aid=0, bvid='', qn=16, reverse_proxy='', fnval=0):
+        "获取视频播放地址，fnval为16时返回DASH格式(视频音频分离，包含所有清晰度)"
         if reverse_proxy:
             url = reverse_proxy
         else:
             url = 'https://api.bilibili.com/x/player/playurl'
-        #data = {"qn":qn,"cid":cid,'fnval':80}
         data = {"qn":qn,"cid":cid}
+        if fnval:
+            data["fnval"] = fnval
+            data["fourk"] = 1
         if aid:
             data["avid"] = aid
         if bvid:
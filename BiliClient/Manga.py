@@ -1,4 +1,171 @@
 from . import bili
+from concurrent.futures import ThreadPoolExecutor
+from aiohttp import ClientError
+from .util import atomicWrite, backoff
+import os, time, json, queue, asyncio, hashlib, logging, threading, requests
+
+def _comicPath(path: str, title: str) -> str:
+    "创建并返回漫画的保存目录"
+    if not os.path.exists(path):
+        os.mkdir(path)
+    if path[-1] == '/':
+        path = f'{path}{title}'
+    else:
+        path = f'{path}/{title}'
+    if not os.path.exists(path):
+        os.mkdir(path)
+    return path
+
+def _listChapters(detail: dict, path: str, manifest: '_Manifest') -> tuple:
+    "按章节顺序返回要下载的章节[(章节名, 保存路径, 章节id)]和要导出的章节id，跳过已完整下载和需要解锁的章节"
+    bq = len(str(detail["last_ord"]))
+    chapters = []
+    order = []
+    for x in detail["ep_list"]:
+        name = x["title"]
+        if name.replace(' ', '') == '':
+            name = x["short_title"]
+        name = f'{x["ord"]:0>{bq}}-{name}'
+        if manifest.isComplete(x["id"]):
+            logging.debug(f'{name} 已下载，跳过')
+            order.append(x["id"])
+        elif not x["is_locked"]:
+            chapters.append((name, f'{path}/{name}', x["id"]))
+            order.append(x["id"])
+        else:
+            logging.info(f'{name} 目前需要解锁')
+    return chapters, order
+
+def _startChapter(manifest: '_Manifest', name: str, ep_path: str, ep_id: int, url_list: list) -> list:
+    "创建章节目录并开始记录，返回需要下载的新的和不完整的图片[(页码, 图片地址, 保存路径)]"
+    if not os.path.exists(ep_path):
+        os.mkdir(ep_path)
+    manifest.startChapter(ep_id, name, len(url_list))
+    pages = [(n, url, f'{ep_path}/{n:0>2}.jpg') for n, url in enumerate(url_list, 1)]
+    return [x for x in pages if not manifest.hasPage(ep_id, x[0], x[2])]
+
+def _exportComplete(manifest: '_Manifest', exporter: '_OrderedExport', order: list) -> None:
+    "导出已经完整下载的章节"
+    for ep_id in order:
+        if manifest.isComplete(ep_id):
+            exporter.finish(ep_id)
+
+class _Manifest(object):
+    "漫画的下载记录(漫画目录下的manifest.json)，记录每个章节每张图片的路径、大小和哈希，相同内容的图片只保存一份"
+    def __init__(self, path: str):
+        self._root = path
+        self._file = f'{path}/manifest.json'
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock() #多个线程同时保存时使用同一个临时文件
+        try:
+            with open(self._file, 'r', encoding='utf-8') as fp:
+                self._data = json.load(fp)
+        except (OSError, ValueError):
+            self._data = {"chapters": {}, "hashes": {}}
+
+    def _exists(self, page: dict) -> bool:
+        "记录的图片文件是否还在且大小一致"
+        filename = f'{self._root}/{page["path"]}'
+        return os.path.exists(filename) and os.path.getsize(filename) == page["size"]
+
+    def isComplete(self, ep_id: int) -> bool:
+        "章节是否已经完整下载"
+        chapter = self._data["chapters"].get(str(ep_id))
+        return bool(chapter and chapter["complete"] and all(x and self._exists(x) for x in chapter["pages"]))
+
+    def hasPage(self, ep_id: int, n: int, filename: str) -> bool:
+        "章节的第n张图片是否已经下载"
+        pages = self._data["chapters"][str(ep_id)]["pages"]
+        page = pages[n - 1]
+        return bool(page and page["path"] == os.path.relpath(filename, self._root).replace('\\', '/') and self._exists(page))
+
+    def startChapter(self, ep_id: int, name: str, num: int) -> None:
+        "开始下载章节，图片数量改变时重新记录"
+        with self._lock:
+            chapter = self._data["chapters"].get(str(ep_id))
+            if not chapter or len(chapter["pages"]) != num:
+                chapter = {"name": name, "complete": False, "pages": [None] * num}
+                self._data["chapters"][str(ep_id)] = chapter
+            chapter["name"] = name
+
+    def savePage(self, ep_id: int, n: int, filename: str, data: bytes) -> None:
+        "保存章节的第n张图片，已有相同内容的图片时创建硬链接，不支持硬链接时直接写入"
+        digest = hashlib.sha1(data).hexdigest()
+        rel = os.path.relpath(filename, self._root).replace('\\', '/')
+        with self._lock:
+            same = self._data["hashes"].get(digest)
+        linked = False
+        if same and same != rel and os.path.exists(f'{self._root}/{same}') and os.path.getsize(f'{self._root}/{same}') == len(data):
+            try:
+                if os.path.exists(f'{filename}.tmp'):
+                    os.remove(f'{filename}.tmp')
+                os.link(f'{self._root}/{same}', f'{filename}.tmp')
+                os.replace(f'{filename}.tmp', filename)
+                linked = True
+            except OSError:
+                pass
+        if not linked:
+            atomicWrite(filename, data)
+        with self._lock:
+            self._data["hashes"].setdefault(digest, rel)
+            self._data["chapters"][str(ep_id)]["pages"][n - 1] = {"path": rel, "size": len(data), "hash": digest}
+
+    def finishChapter(self, ep_id: int) -> None:
+        "章节结束，所有图片都下载成功时标记为完成，并保存记录"
+        with self._lock:
+            chapter = self._data["chapters"][str(ep_id)]
+            chapter["complete"] = all(chapter["pages"])
+        self.save()
+
+    def chapters(self) -> dict:
+        "章节id->{name, complete, pages}"
+        return self._data["chapters"]
+
+    def save(self) -> None:
+        with self._save_lock:
+            with self._lock:
+                data = json.dumps(self._data, ensure_ascii=False)
+            atomicWrite(self._file, data.encode('utf-8')) #在锁内序列化，避免保存时记录被其他线程修改
+
+class _OrderedExport(object):
+    "按章节顺序导出图片，章节下载完成后立即写入，前面的章节没有结束时先等待"
+    def __init__(self, order: list, manifest: _Manifest, root: str, writers: list):
+        self._order = order #要导出的章节id，按章节顺序
+        self._manifest = manifest
+        self._root = root
+        self._writers = writers
+        self._finished = set()
+        self._next = 0
+        self._lock = threading.Lock() #章节在不同线程中结束，保证按顺序写入
+
+    def finish(self, ep_id: int) -> None:
+        "章节结束(成功或失败)，写入所有已经轮到的章节"
+        with self._lock:
+            self._finished.add(ep_id)
+            self._flush()
+
+    def close(self) -> None:
+        "写入剩下的章节，没有结束的章节(获取图片列表失败等)跳过"
+        with self._lock:
+            self._finished.update(self._order)
+            self._flush()
+
+    def _flush(self) -> None:
+        while self._next < len(self._order) and self._order[self._next] in self._finished:
+            self._write(self._order[self._next])
+            self._next += 1
+
+    def _write(self, ep_id: int) -> None:
+        chapter = self._manifest.chapters().get(str(ep_id))
+        if not chapter or not self._manifest.isComplete(ep_id):
+            logging.warning(f'{chapter["name"] if chapter else ep_id} 没有完整下载，导出时跳过')
+            return
+        for page in chapter["pages"]:
+            for writer in self._writers:
+                try:
+                    writer.addPage(f'{self._root}/{page["path"]}', page["path"])
+                except ValueError as e:
+                    logging.warning(f'{page["path"]} 导出失败，原因为{str(e)}')
 
 class MangaDownloader(object):
     "B站漫画下载类"
@@ -53,42 +220,311 @@ class MangaDownloader(object):
         url_list = [f'{x["url"]}?token={x["token"]}' for x in data]
         return url_list
 
-    def download(self, ep_id: int, path: str):
-        "下载一个章节"
-        import os
+    def download(self, ep_id: int, path: str, threads=8, retries=3):
+        "下载一个章节，threads为同时下载的图片数量，返回按顺序排列的图片路径"
         if not os.path.exists(path):
             os.mkdir(path)
 
-        import requests
-        _s = requests.session()
+        url_list = self.getDownloadList(ep_id)
+        files = [f'{path}/{n:0>2}.jpg' for n in range(1, len(url_list) + 1)] #文件名按页码顺序
+        self._imageSession() #在多个线程使用前创建会话
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            for x in executor.map(lambda x: self._saveImage(x[0], x[1], retries), zip(url_list, files)):
+                pass #图片下载完成后立即写入各自的文件，这里只等待全部完成并抛出异常
+        return files
+
+    def _saveImage(self, url: str, filename: str, retries=3, manifest=None, ep_id=0, n=0):
+        "下载一张图片并写入文件，失败时只重试这张图片，指定manifest时记录到下载记录中"
+        for attempt in range(retries + 1):
+            try:
+                r = self._imageSession().get(url, timeout=30)
+                r.raise_for_status()
+                break
+            except requests.RequestException:
+                if attempt == retries:
+                    raise
+                time.sleep(backoff(attempt)) #指数退避后重试
+        if manifest:
+            manifest.savePage(ep_id, n, filename, r.content)
+        else:
+            atomicWrite(filename, r.content) #中断时不会留下不完整的图片
+
+    def _imageSession(self):
+        "下载图片用的会话，不带账户cookie，连接池在线程间共用"
+        if not hasattr(self, '_image_session'):
+            self._image_session = requests.session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=32)
+            self._image_session.mount('https://', adapter)
+            self._image_session.mount('http://', adapter)
+        return self._image_session
+
+    def downloadAll(self, path, threads=8, retries=3, batch=5, export: list = None):
+        '''
+        下载漫画所有可下载章节
+        threads int 所有章节共用的同时下载图片数量
+        batch int 每次一起获取图片列表和token的章节数量，图片下载的同时准备后面的章节
+        export list 导出器(如mangaexport.CbzWriter、PdfWriter)，章节下载完成后按章节和页码顺序写入，由调用者关闭
+        '''
+        path = _comicPath(path, self.getTitle())
+        logging.info(f'开始下载漫画 "{self.getTitle()}"')
+        manifest = _Manifest(path) #已下载的章节和图片，再次运行时跳过
+        chapters, order = _listChapters(self._manga_detail, path, manifest)
+
+        exporter = _OrderedExport(order, manifest, path, export) if export else None
+        if exporter:
+            _exportComplete(manifest, exporter, order) #已下载的章节直接导出
+
+        todo = queue.Queue(maxsize=batch) #准备好的章节，容量限制提前获取的token数量，避免token过期
+        threading.Thread(target=self._prepareChapters, args=(chapters, todo, batch), daemon=True).start()
+
+        slots = threading.BoundedSemaphore(threads * 2) #限制已提交但未完成的图片数量
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            while True:
+                item = todo.get()
+                if item is None:
+                    break
+                name, ep_path, ep_id, url_list = item
+                pages = _startChapter(manifest, name, ep_path, ep_id, url_list)
+                if not pages:
+                    manifest.finishChapter(ep_id)
+                    logging.info(f'{name} 下载完成')
+                    if exporter:
+                        exporter.finish(ep_id)
+                    continue
+                chapter = {"left": len(pages), "failed": 0, "lock": threading.Lock()}
+                def done(future, name=name, ep_id=ep_id, chapter=chapter):
+                    slots.release()
+                    with chapter["lock"]:
+                        chapter["left"] -= 1
+                        if future.exception():
+                            chapter["failed"] += 1
+                        if chapter["left"]:
+                            return
+                    if chapter["failed"]:
+                        logging.warning(f'{name} 有{chapter["failed"]}张图片下载失败')
+                    else:
+                        logging.info(f'{name} 下载完成')
+                    manifest.finishChapter(ep_id)
+                    if exporter:
+                        exporter.finish(ep_id)
+                for n, url, filename in pages:
+                    slots.acquire()
+                    future = executor.submit(self._saveImage, url, filename, retries, manifest, ep_id, n)
+                    future.add_done_callback(done)
+        manifest.save()
+        if exporter:
+            exporter.close()
+
+    def _prepareChapters(self, chapters: list, todo: queue.Queue, batch: int):
+        "在后台线程中每次并发获取batch个章节的图片列表，再用一次请求取得这些章节所有图片的token，放入todo队列"
+        self._imageSession()
+        try:
+            with ThreadPoolExecutor(max_workers=batch) as executor:
+                for ii in range(0, len(chapters), batch):
+                    group = chapters[ii:ii + batch]
+                    indexes = list(executor.map(self._imageIndex, group))
+                    group = [(x, y) for x, y in zip(group, indexes) if y is not None]
+                    try:
+                        url_list = self._imageTokens([path for x, images in group for path in images])
+                    except Exception as e:
+                        for (name, ep_path, ep_id), images in group:
+                            logging.warning(f'{name} 获取图片token失败，原因为{str(e)}')
+                        continue
+                    pos = 0
+                    for (name, ep_path, ep_id), images in group:
+                        todo.put((name, ep_path, ep_id, url_list[pos:pos + len(images)]))
+                        pos += len(images)
+        finally:
+            todo.put(None)
+
+    def _imageIndex(self, chapter: tuple):
+        "取得章节的图片路径列表，失败返回None"
+        name, ep_path, ep_id = chapter
+        try:
+            return [x["path"] for x in bili.mangaImageIndex(self, ep_id)["data"]["images"]]
+        except Exception as e:
+            logging.warning(f'{name} 获取图片列表失败，原因为{str(e)}')
+            return None
+
+    def _imageTokens(self, paths: list, size=100):
+        "每次最多size张图片，批量取得带token的图片地址"
+        url_list = []
+        for ii in range(0, len(paths), size):
+            data = bili.mangaImageToken(self, paths[ii:ii + size])["data"]
+            url_list.extend(f'{x["url"]}?token={x["token"]}' for x in data)
+        return url_list
+
+class AsyncMangaDownloader(object):
+    "B站漫画异步下载类，使用asyncBiliApi的连接池和账户，可以和其他异步任务在同一个事件循环中运行"
+    def __init__(self, biliapi: 'asyncBiliApi'):
+        '''
+        biliapi asyncBiliApi 已登录(或未登录)的异步接口，由调用者负责关闭
+        '''
+        self._biliapi = biliapi
+        self._manga_detail = None
+
+    async def setComicId(self, comic_id: int):
+        "设置当前漫画id并获取漫画信息，其他方法需要先调用此方法"
+        self._manga_detail = (await self._biliapi.mangaDetail(comic_id))["data"]
+        self._comic_id = self._manga_detail["id"]
+        self._manga_detail["ep_list"].sort(key=lambda elem: elem["ord"])
+
+    def getIndex(self):
+        "获取漫画章节列表"
+        return self._manga_detail["ep_list"]
+
+    def getTitle(self):
+        "获取漫画名称"
+        return self._manga_detail["title"]
+
+    def getAuthors(self):
+        "获取漫画作者名称(数组)"
+        return self._manga_detail["author_name"]
+
+    def getCover(self):
+        "获取漫画封面图片链接"
+        return self._manga_detail["vertical_cover"]
+
+    def getNum(self):
+        "获取漫画章节数量"
+        return self._manga_detail["last_ord"]
 
-        list = self.getDownloadList(ep_id)
-        n = 0
-        for x in list:
-            n += 1
-            with open(f'{path}/{n:0>2}.jpg', 'wb') as f:
-                f.write(_s.get(x).content)
+    async def getDownloadList(self, ep_id: int):
+        "获取漫画章节下载列表"
+        data = (await self._biliapi.mangaImageIndex(ep_id))["data"]["images"]
+        return await self._imageTokens([x["path"] for x in data])
 
-    def downloadAll(self, path):
-        "下载漫画所有可下载章节"
-        import os
+    async def download(self, ep_id: int, path: str, concurrency=8, retries=3):
+        "下载一个章节，concurrency为同时下载的图片数量，返回按顺序排列的图片路径"
         if not os.path.exists(path):
             os.mkdir(path)
-        title = self.getTitle()
-        if path[-1] == '/':
-            path = f'{path}{title}'
+
+        url_list = await self.getDownloadList(ep_id)
+        files = [f'{path}/{n:0>2}.jpg' for n in range(1, len(url_list) + 1)] #文件名按页码顺序
+        slots = asyncio.Semaphore(concurrency)
+        async def save(url, filename):
+            async with slots:
+                await self._saveImage(url, filename, retries)
+        await asyncio.gather(*[save(url, filename) for url, filename in zip(url_list, files)])
+        return files
+
+    async def _saveImage(self, url: str, filename: str, retries=3, manifest=None, ep_id=0, n=0):
+        "下载一张图片并写入文件，失败时只重试这张图片，文件在线程池中写入，不阻塞事件循环"
+        for attempt in range(retries + 1):
+            try:
+                data = await self._biliapi.mangaGetImageBytes(url)
+                break
+            except (ClientError, asyncio.TimeoutError):
+                if attempt == retries:
+                    raise
+                await asyncio.sleep(backoff(attempt)) #指数退避后重试
+        loop = asyncio.get_running_loop()
+        if manifest:
+            await loop.run_in_executor(None, manifest.savePage, ep_id, n, filename, data)
         else:
-            path = f'{path}/{title}'
-        if not os.path.exists(path):
-            os.mkdir(path)
-        print(f'开始下载漫画 "{title}"')
-        bq = len(str(self.getNum()))
-        for x in self.getIndex():
-            name = x["title"]
-            if name.replace(' ', '') == '':
-                name = x["short_title"]
-            if not x["is_locked"]:
-                self.download(x['id'], f'{path}/{x["ord"]:0>{bq}}-{name}')
-                print(f'{x["ord"]:0>{bq}}-{name} 下载完成')
-            else:
-                print(f'{x["ord"]:0>{bq}}-{name} 目前需要解锁')
+            await loop.run_in_executor(None, atomicWrite, filename, data)
+
+    async def downloadAll(self, path, concurrency=8, retries=3, batch=5, export: list = None):
+        '''
+        下载漫画所有可下载章节，下载记录和目录结构与MangaDownloader.downloadAll相同
+        concurrency int 所有章节共用的同时下载图片数量
+        batch int 每次一起获取图片列表和token的章节数量，图片下载的同时准备后面的章节
+        export list 导出器(如mangaexport.CbzWriter、PdfWriter)，章节下载完成后按章节和页码顺序写入，由调用者关闭
+        '''
+        loop = asyncio.get_running_loop()
+        path = await loop.run_in_executor(None, _comicPath, path, self.getTitle())
+        logging.info(f'开始下载漫画 "{self.getTitle()}"')
+        manifest = await loop.run_in_executor(None, _Manifest, path) #已下载的章节和图片，再次运行时跳过
+        chapters, order = await loop.run_in_executor(None, _listChapters, self._manga_detail, path, manifest)
+
+        exporter = _OrderedExport(order, manifest, path, export) if export else None
+        if exporter:
+            await loop.run_in_executor(None, _exportComplete, manifest, exporter, order) #已下载的章节直接导出
+
+        todo = asyncio.Queue(maxsize=batch) #准备好的章节，容量限制提前获取的token数量，避免token过期
+        producer = asyncio.ensure_future(self._prepareChapters(chapters, todo, batch))
+        slots = asyncio.Semaphore(concurrency) #限制正在下载的图片数量，图片下载跟不上时不再取出新的章节
+        images = [] #所有图片的下载任务
+        finishing = []
+        try:
+            while True:
+                item = await todo.get()
+                if item is None:
+                    break
+                name, ep_path, ep_id, url_list = item
+                pages = await loop.run_in_executor(None, _startChapter, manifest, name, ep_path, ep_id, url_list)
+                tasks = []
+                for n, url, filename in pages:
+                    await slots.acquire()
+                    task = asyncio.ensure_future(self._saveImage(url, filename, retries, manifest, ep_id, n))
+                    task.add_done_callback(lambda x: slots.release())
+                    tasks.append(task)
+                images.extend(tasks)
+                finishing.append(asyncio.ensure_future(self._finishChapter(name, ep_id, tasks, manifest, exporter)))
+            await asyncio.gather(*finishing)
+            await producer #准备章节时的异常
+        finally:
+            producer.cancel() #出错或被取消时停止准备章节和下载
+            for x in finishing + images:
+                x.cancel()
+            while not todo.empty(): #让准备章节的任务能放入结束标记
+                todo.get_nowait()
+            await asyncio.gather(producer, *finishing, *images, return_exceptions=True)
+        await loop.run_in_executor(None, manifest.save)
+        if exporter:
+            await loop.run_in_executor(None, exporter.close)
+
+    async def _finishChapter(self, name: str, ep_id: int, tasks: list, manifest: _Manifest, exporter: _OrderedExport):
+        "等待章节的所有图片下载结束，保存下载记录并导出"
+        try:
+            result = await asyncio.gather(*tasks, return_exceptions=True)
+        except asyncio.CancelledError:
+            for x in tasks:
+                x.cancel()
+            raise
+        failed = sum(1 for x in result if isinstance(x, Exception))
+        if failed:
+            logging.warning(f'{name} 有{failed}张图片下载失败')
+        else:
+            logging.info(f'{name} 下载完成')
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, manifest.finishChapter, ep_id)
+        if exporter:
+            await loop.run_in_executor(None, exporter.finish, ep_id)
+
+    async def _prepareChapters(self, chapters: list, todo: asyncio.Queue, batch: int):
+        "每次并发获取batch个章节的图片列表，再用一次请求取得这些章节所有图片的token，放入todo队列，结束(包括出错)时放入None"
+        try:
+            for ii in range(0, len(chapters), batch):
+                group = chapters[ii:ii + batch]
+                indexes = await asyncio.gather(*[self._imageIndex(x) for x in group])
+                group = [(x, y) for x, y in zip(group, indexes) if y is not None]
+                try:
+                    url_list = await self._imageTokens([path for x, images in group for path in images])
+                except Exception as e:
+                    for (name, ep_path, ep_id), images in group:
+                        logging.warning(f'{name} 获取图片token失败，原因为{str(e)}')
+                    continue
+                pos = 0
+                for (name, ep_path, ep_id), images in group:
+                    await todo.put((name, ep_path, ep_id, url_list[pos:pos + len(images)]))
+                    pos += len(images)
+        finally:
+            await todo.put(None)
+
+    async def _imageIndex(self, chapter: tuple):
+        "取得章节的图片路径列表，失败返回None"
+        name, ep_path, ep_id = chapter
+        try:
+            return [x["path"] for x in (await self._biliapi.mangaImageIndex(ep_id))["data"]["images"]]
+        except Exception as e:
+            logging.warning(f'{name} 获取图片列表失败，原因为{str(e)}')
+            return None
+
+    async def _imageTokens(self, paths: list, size=100):
+        "每次最多size张图片，批量取得带token的图片地址"
+        url_list = []
+        for ii in range(0, len(paths), size):
+            data = (await self._biliapi.mangaImageToken(paths[ii:ii + size]))["data"]
+            url_list.extend(f'{x["url"]}?token={x["token"]}' for x in data)
+        return url_list
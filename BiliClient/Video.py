@@ -1,7 +1,12 @@
 # -*- coding: utf-8 -*-
 from . import bili
-import os, math, time
+import os, math, time, json, mmap, queue, logging, threading, asyncio, functools, requests
+from concurrent.futures import ThreadPoolExecutor
 from .aria2py import Aria2Py
+from .rangedownloader import RangeDownloader
+from .mp4mux import remux
+from .util import atomicWriteJson, backoff
+from .cache import TTLCache #allStream是同步方法，会在多个线程中调用，所以不能使用AsyncCache
 
 class VideoUploader(object):
     "B站视频上传类"
@@ -17,7 +22,7 @@ class VideoUploader(object):
     #本类只继承BiliApi中与Video上传有关的方法
     def __init__(self, cookieData: dict = None, title="", desc="", dtime=0, tag=[], copyright=2, tid=174, source="", cover="",desc_format_id=0, subtitle={"open":0,"lan":""}):
         "创建一个B站视频上传类"               #简介
-        bili.__init__(self, cookieData)
+        bili.__init__(self)
         if cookieData:
             bili.login_by_cookie(self, cookieData)
 
@@ -44,41 +49,248 @@ class VideoUploader(object):
                 self._data["dynamic"] += f'{tag[i]},'
             self._data["tag"] += f'#{tag[i]}#'
 
-    def uploadFile(self, filepath: '视频路径', fsize=8388608):
-        "上传本地视频文件,返回视频信息dict"
+    def uploadFile(self, filepath: '视频路径', fsize=None, threads=None, retries=3, resume=True, resume_expire=43200, max_threads=None, callback=None):
+        '''
+        上传本地视频文件,返回视频信息dict，resume为True时记录上传进度，中断后再次上传同一文件会跳过已完成的分块
+        fsize int 分块大小，默认使用服务器建议值，同一上传服务器已上传过视频时按上次测得的速度选择(不同的VideoUploader对象共用)
+        threads int 初始同时上传的分块数量，默认使用服务器建议值
+        max_threads int 同时上传的分块数量上限，上传过程中会根据吞吐量在1到此值之间调整，默认为初始值的两倍
+        callback function 进度回调，参数为(进度0-1, 平均速度 字节/秒)
+        '''
         
         path,name = os.path.split(filepath)#分离路径与文件名
+        checkpoint = f'{filepath}.upload.json' if resume else None #上传进度文件
 
         with open(filepath,'rb') as f: 
             size = f.seek(0, 2) #获取文件大小
-            chunks = math.ceil(size / fsize) #获取分块数量
-
-            retobj = self.videoPreupload(name, size) #申请上传
-            auth = retobj["auth"]
-            endpoint = retobj["endpoint"]
-            biz_id = retobj["biz_id"]
-            upos_uri = retobj["upos_uri"][6:] 
-            rname = os.path.splitext(upos_uri[5:])[0]
-            url = f'https:{endpoint}{upos_uri}'  #视频上传路径
-
-            retobj = self.videoUploadId(url, auth)
-            upload_id = retobj["upload_id"] #得到上传id
-
-            #开始上传
-            parts = [] #分块信息
-            f.seek(0, 0)
-            for i in range(chunks): #单线程分块上传，官方支持三线程
-                data = f.read(fsize) #一次读取一个分块大小
-                self.videoUpload(url, auth, upload_id, data, i, chunks, i*fsize, size)#上传分块
-                parts.append({"partNumber":i+1,"eTag":"etag"}) #添加分块信息，partNumber从1开始
-                #print(f'{i} / {chunks}')#输出上传进度
+            mtime = os.fstat(f.fileno()).st_mtime
+
+            state = self._loadCheckpoint(checkpoint, size, mtime, resume_expire) if checkpoint else None
+            if state:
+                ret, rejected = self._uploadSession(f, name, size, state, checkpoint, threads, retries, max_threads, callback)
+                if ret["filename"] or not rejected:
+                    return ret
+                logging.warning(f'{name} 续传的上传会话已被服务器拒绝，重新上传')
+                self._removeCheckpoint(checkpoint)
+
+            state = self._preupload(name, size, fsize)
+            state["mtime"] = mtime
+            if checkpoint and not self._saveCheckpoint(checkpoint, state):
+                checkpoint = None
+            return self._uploadSession(f, name, size, state, checkpoint, threads, retries, max_threads, callback)[0]
+
+    def _uploadSession(self, f, name, size, state, checkpoint, threads, retries, max_threads, callback):
+        "在一个上传会话中上传文件f未完成的分块并提交，返回(视频信息dict, 服务器是否拒绝了上传)，checkpoint为None时不记录进度"
+        fsize = state["fsize"] #同一次上传会话内分块大小不能改变
+        threads = threads or state.get("threads", 3)
+        url = f'https:{state["endpoint"]}{state["upos_uri"]}'  #视频上传路径
+        chunks = math.ceil(size / fsize) #获取分块数量
+
+        #开始上传
+        lock = threading.Lock()
+        done = set(state["done"])
+        saved = [time.monotonic()]
+        def on_done(i):
+            nonlocal checkpoint
+            with lock:
+                done.add(i)
+                now = time.monotonic()
+                if not checkpoint or (now - saved[0] < 5 and len(done) < chunks): #最多每5秒保存一次进度
+                    return
+                saved[0] = now
+                state["done"] = sorted(done)
+                if not self._saveCheckpoint(checkpoint, state):
+                    checkpoint = None
+
+        uploaded = sum(min(fsize, size - i*fsize) for i in done) #续传时已完成的字节数
+        monitor = _UploadMonitor(size, uploaded, threads, max_threads or threads * 2, callback)
+        #每个分块单独映射，以memoryview交给requests发送，不复制数据，分块上传结束后关闭映射，内存占用只与同时上传的分块有关
+        read = lambda i: _mapChunk(f.fileno(), i*fsize, min(fsize, size - i*fsize))
+        ok = self._uploadParts(url, state["auth"], state["upload_id"], read, chunks, fsize, size, monitor, retries, set(done), on_done)
+        self._uploadStats = _upload_stats[state["endpoint"]] = monitor.summary(fsize)
+        if checkpoint and not ok:
+            with lock:
+                state["done"] = sorted(done)
+            self._saveCheckpoint(checkpoint, state) #上传失败时保存最新进度
+
+        ret = self._finishUpload(state, name, chunks, ok)
+        if ret["filename"] and checkpoint:
+            self._removeCheckpoint(checkpoint) #上传完成后删除进度文件
+        return ret, monitor.rejected > 0 or (ok and not ret["filename"])
+
+    def uploadStream(self, stream, size: int, filename: str, fsize=None, threads=None, retries=3, max_threads=None, callback=None):
+        '''
+        边读取边上传视频数据，不需要先保存到本地，返回视频信息dict(与uploadFile相同)
+        stream 有read方法的文件对象(如管道)、bytes的迭代器或自带事件循环的异步迭代器(在事件循环中请使用uploadStreamAsync)
+        size int 视频总字节数，B站需要在上传前知道文件大小
+        filename str 视频文件名
+        其他参数与uploadFile相同，数据只能读取一次所以不支持断点续传
+        '''
+        state = self._preupload(filename, size, fsize)
+        fsize = state["fsize"]
+        threads = threads or state["threads"]
+        url = f'https:{state["endpoint"]}{state["upos_uri"]}'  #视频上传路径
+        chunks = math.ceil(size / fsize) #获取分块数量
+
+        reader = _ChunkReader(stream, fsize)
+        def read(i):
+            data = reader.read()
+            if len(data) != min(fsize, size - i*fsize):
+                raise ValueError(f'视频数据长度与size({size})不符')
+            return memoryview(data)
+
+        monitor = _UploadMonitor(size, 0, threads, max_threads or threads * 2, callback)
+        try:
+            ok = self._uploadParts(url, state["auth"], state["upload_id"], read, chunks, fsize, size, monitor, retries)
+        finally:
+            reader.close()
+        self._uploadStats = _upload_stats[state["endpoint"]] = monitor.summary(fsize)
+        return self._finishUpload(state, filename, chunks, ok)
+
+    async def uploadStreamAsync(self, stream, size: int, filename: str, **kwargs):
+        '''
+        uploadStream的异步版本，上传在线程池中进行，不阻塞事件循环
+        stream 异步迭代器在调用者的事件循环中读取，可以直接传入aiohttp的resp.content.iter_chunked()
+        其他参数与uploadStream相同
+        '''
+        loop = asyncio.get_running_loop()
+        if not hasattr(stream, '__aiter__'):
+            return await loop.run_in_executor(None, functools.partial(self.uploadStream, stream, size, filename, **kwargs))
+        iterator = _iterAsync(stream, loop)
+        def upload():
+            try:
+                return self.uploadStream(iterator, size, filename, **kwargs)
+            finally:
+                iterator.close() #在上传线程中关闭，关闭时需要等待事件循环
+        return await loop.run_in_executor(None, upload)
+
+    def _preupload(self, name, size, fsize=None):
+        "申请上传并取得上传id，返回上传会话信息dict"
+        retobj = self.videoPreupload(name, size) #申请上传
+        state = {
+            "auth": retobj["auth"],
+            "endpoint": retobj["endpoint"],
+            "biz_id": retobj["biz_id"],
+            "upos_uri": retobj["upos_uri"][6:],
+            "size": size,
+            "fsize": fsize or self._chooseChunkSize(retobj.get("chunk_size", 8388608), retobj["endpoint"]),
+            "threads": retobj.get("threads", 3), #服务器建议的线程数
+            "time": int(time.time()),
+            "done": []
+            }
+        url = f'https:{state["endpoint"]}{state["upos_uri"]}'  #视频上传路径
+        state["upload_id"] = self.videoUploadId(url, state["auth"])["upload_id"] #得到上传id
+        return state
 
+    def _finishUpload(self, state, name, chunks, ok):
+        "所有分块上传后提交分块信息，返回视频信息dict"
         preffix = os.path.splitext(name)[0]
-        retobj = self.videoUploadInfo(url, auth, parts, name, upload_id, biz_id)
+        if not ok:
+            return {"title": preffix, "filename": "", "desc": ""}
+        parts = [{"partNumber":i+1,"eTag":"etag"} for i in range(chunks)] #分块信息，partNumber从1开始且按顺序排列
+        url = f'https:{state["endpoint"]}{state["upos_uri"]}'
+        retobj = self.videoUploadInfo(url, state["auth"], parts, name, state["upload_id"], state["biz_id"])
         if (retobj["OK"] == 1):
+            rname = os.path.splitext(state["upos_uri"][5:])[0]
             return {"title": preffix, "filename": rname, "desc": ""}
         return {"title": preffix, "filename": "", "desc": ""}
 
+    def getUploadStats(self):
+        "返回上一次uploadFile或uploadStream的统计信息dict(字节数、耗时、MB/s、重试次数、分块大小、最终线程数等)，没有上传过返回None"
+        return getattr(self, '_uploadStats', None)
+
+    @staticmethod
+    def _chooseChunkSize(server_size, endpoint):
+        "选择新上传会话的分块大小，按同一上传服务器上次上传分块的平均耗时放大或缩小上次的分块大小，使单个分块约10秒完成，不超过服务器建议值"
+        stats = _upload_stats.get(endpoint)
+        if not stats or not stats["chunks"]:
+            return server_size
+        per_chunk = stats["latency"] / stats["chunks"] #上次单个分块请求的平均耗时
+        scale = min(2, max(0.5, 10 / max(per_chunk, 1e-6))) #每次最多放大或缩小一倍，避免一次测量偏差过大
+        size = int(stats["chunk_size"] * scale) // 1048576 * 1048576
+        return max(min(1048576, server_size), min(server_size, size))
+
+    @staticmethod
+    def _loadCheckpoint(checkpoint, size, mtime, expire):
+        "读取上传进度，文件被修改或上传会话已过期时返回None"
+        try:
+            with open(checkpoint, 'r', encoding='utf-8') as fp:
+                state = json.load(fp)
+        except (OSError, ValueError):
+            return None
+        if state.get("size") != size or state.get("mtime") != mtime or time.time() - state.get("time", 0) > expire:
+            return None
+        return state
+
+    @staticmethod
+    def _saveCheckpoint(checkpoint, state):
+        "保存上传进度，返回是否成功，不能写入(如只读目录)时不影响上传，只是不能续传"
+        try:
+            atomicWriteJson(checkpoint, state)
+            return True
+        except OSError as e:
+            logging.warning(f'保存上传进度文件{checkpoint}失败，原因为{str(e)}，本次上传不支持断点续传')
+            return False
+
+    @staticmethod
+    def _removeCheckpoint(checkpoint):
+        try:
+            os.remove(checkpoint)
+        except OSError:
+            pass
+
+    def _uploadParts(self, url, auth, upload_id, read, chunks, fsize, size, monitor, retries, done=(), on_done=None):
+        "多线程上传所有分块(官方为三线程)，read(i)按顺序返回第i个分块的memoryview，跳过done中已完成的分块，全部成功返回True"
+        futures = []
+        failed = threading.Event() #有分块重试后仍然失败时不再上传剩下的分块
+        with ThreadPoolExecutor(max_workers=monitor.max_threads) as executor:
+            for i in range(chunks):
+                if i in done:
+                    continue
+                monitor.acquire() #同时上传的分块数量由monitor根据吞吐量调整
+                if failed.is_set():
+                    monitor.release(0, 0, False)
+                    break
+                try:
+                    data = read(i) #按顺序读取，数据流只能依次读取
+                except Exception:
+                    monitor.release(0, 0, False)
+                    raise
+                future = executor.submit(self._uploadChunk, url, auth, upload_id, data, i, chunks, fsize, size, monitor, retries)
+                future.add_done_callback(lambda x: (x.exception() or not x.result()) and failed.set())
+                if on_done:
+                    future.add_done_callback(lambda x, i=i: not x.exception() and x.result() and on_done(i))
+                futures.append(future)
+        return not failed.is_set() and all(x.result() for x in futures)
+
+    def _uploadChunk(self, url, auth, upload_id, data, i, chunks, fsize, size, monitor, retries):
+        "上传一个分块，data为第i个分块的memoryview，失败时只重试这个分块"
+        start = time.monotonic()
+        ok = False
+        owner = data.obj
+        try:
+            with data: #分块的memoryview必须在关闭mmap前释放
+                for attempt in range(retries + 1):
+                    start = time.monotonic()
+                    try:
+                        if self.videoUpload(url, auth, upload_id, data, i, chunks, i*fsize, size):
+                            ok = True
+                            return True
+                    except requests.HTTPError as e:
+                        if e.response is not None and e.response.status_code in _REJECT_STATUS:
+                            monitor.reject() #认证失败或上传id无效，上传会话已失效，重试没有意义
+                            return False
+                    except requests.RequestException:
+                        pass #网络异常、5xx和无法识别的返回内容(如网关错误页面)只重试这个分块
+                    monitor.retry()
+                    if attempt < retries:
+                        time.sleep(backoff(attempt)) #指数退避后重试
+            return False
+        finally:
+            if isinstance(owner, mmap.mmap):
+                owner.close() #释放分块的映射
+            monitor.release(min(fsize, size - i*fsize), time.monotonic() - start, ok)
+
     def submit(self):
         if self._data["title"] == "":
             self._data["title"] = self._data["videos"][0]["title"]
@@ -168,6 +380,212 @@ class VideoUploader(object):
         "设置subtitle"
         self._data["subtitle"] = subtitle
 
+_REJECT_STATUS = (401, 403, 404) #上传分块时表示认证失败或上传id无效的状态码，续传时需要重新申请上传
+_upload_stats = {} #上传服务器(endpoint)->在该服务器上最近一次上传的统计信息，每次上传通常会创建新的VideoUploader对象，所以不保存在对象中
+
+def _mapChunk(fileno, offset, length):
+    "映射文件中从offset开始的length字节，返回这段数据的memoryview(obj为mmap对象，由使用者释放后关闭)"
+    start = offset // mmap.ALLOCATIONGRANULARITY * mmap.ALLOCATIONGRANULARITY #映射的起始位置必须按分配粒度对齐
+    mm = mmap.mmap(fileno, offset - start + length, access=mmap.ACCESS_READ, offset=start)
+    with memoryview(mm) as view:
+        return view[offset - start:]
+
+class _ChunkReader(object):
+    "从文件对象、迭代器或异步迭代器中按固定大小读取数据"
+    def __init__(self, stream, fsize):
+        self._fsize = fsize
+        self._buffer = bytearray()
+        self._owned = False #只关闭自己创建的迭代器，调用者传入的迭代器由调用者负责
+        if hasattr(stream, 'read'):
+            self._iter = iter(lambda: stream.read(fsize), b'')
+        elif hasattr(stream, '__aiter__'):
+            self._iter = _iterAsync(stream)
+            self._owned = True
+        else:
+            self._iter = iter(stream)
+
+    def close(self):
+        "停止读取，异步迭代器的读取线程随之退出"
+        if self._owned:
+            self._iter.close()
+
+    def read(self):
+        "返回下一个分块，数据不足一个分块时返回剩余的全部数据"
+        while len(self._buffer) < self._fsize:
+            data = next(self._iter, None)
+            if data is None:
+                break
+            self._buffer += data
+        data = bytes(self._buffer[:self._fsize])
+        del self._buffer[:self._fsize]
+        return data
+
+def _iterAsync(aiterable, loop=None, maxsize=16):
+    '''
+    把异步迭代器转换为普通迭代器，供上传线程读取
+    loop 异步迭代器所属的正在运行的事件循环(如aiohttp的响应)，为None时在单独线程的事件循环中运行
+    '''
+    done = object()
+    if loop:
+        it = aiterable.__aiter__()
+        async def anext():
+            try:
+                return await it.__anext__()
+            except StopAsyncIteration:
+                return done
+        try:
+            while True:
+                data = asyncio.run_coroutine_threadsafe(anext(), loop).result() #在所属的事件循环中读取下一块数据
+                if data is done:
+                    return
+                yield data
+        finally:
+            if hasattr(it, 'aclose'): #上传失败时关闭数据源(如异步生成器)
+                asyncio.run_coroutine_threadsafe(it.aclose(), loop).result()
+
+    q = queue.Queue(maxsize) #限制下载领先上传的数据量
+    stop = threading.Event() #上传结束(包括失败)后通知读取线程退出
+    def put(item):
+        "队列满时阻塞这个线程的事件循环，数据源随之暂停，上传结束时放弃"
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+    async def pump():
+        try:
+            async for data in aiterable:
+                if not put(data):
+                    break
+        except Exception as e:
+            put(e)
+        finally:
+            put(done)
+    thread = threading.Thread(target=asyncio.run, args=(pump(),), daemon=True)
+    thread.start()
+    try:
+        while True:
+            data = q.get()
+            if data is done:
+                return
+            if isinstance(data, Exception):
+                raise data
+            yield data
+    finally:
+        stop.set()
+        thread.join()
+
+class _UploadMonitor(object):
+    "统计上传进度与速度，并根据每轮分块的吞吐量调整同时上传的分块数量"
+    def __init__(self, size, uploaded, threads, max_threads, callback=None):
+        self._cond = threading.Condition()
+        self._size = size
+        self._uploaded = uploaded #已完成的字节数(包括续传跳过的分块)
+        self._bytes = 0 #本次上传的字节数
+        self._chunks = 0 #本次成功上传的分块数
+        self._latency = 0.0 #成功分块的请求耗时之和
+        self._retries = 0
+        self.rejected = 0 #服务器拒绝上传会话(认证失败或上传id无效)的次数
+        self._inflight = 0
+        self._threads = threads
+        self.max_threads = max(threads, max_threads)
+        self._callback = callback
+        self._start = time.monotonic()
+        self._round_start = self._start #每完成threads个分块为一轮，按轮比较吞吐量
+        self._round_bytes = 0
+        self._round_chunks = 0
+        self._round_retries = 0
+        self._last_speed = 0
+
+    def acquire(self):
+        "等待直到同时上传的分块数量小于当前线程数"
+        with self._cond:
+            while self._inflight >= self._threads:
+                self._cond.wait()
+            self._inflight += 1
+
+    def reject(self):
+        with self._cond:
+            self.rejected += 1
+
+    def retry(self):
+        with self._cond:
+            self._retries += 1
+            self._round_retries += 1
+
+    def release(self, nbytes, elapsed, ok):
+        "一个分块结束(无论成功与否)"
+        with self._cond:
+            self._inflight -= 1
+            if ok:
+                self._uploaded += nbytes
+                self._bytes += nbytes
+                self._chunks += 1
+                self._latency += elapsed
+                self._round_bytes += nbytes
+            self._round_chunks += 1
+            if self._round_chunks >= self._threads:
+                self._adjust()
+            self._cond.notify_all()
+            progress, speed = self._uploaded / self._size, self.speed
+        if self._callback:
+            self._callback(progress, speed)
+
+    def _adjust(self):
+        "吞吐量上升时增加线程，下降或出现重试时减少线程"
+        now = time.monotonic()
+        speed = self._round_bytes / max(now - self._round_start, 1e-6)
+        if self._round_retries and self._threads > 1:
+            self._threads -= 1
+        elif speed > self._last_speed * 1.05 and self._threads < self.max_threads:
+            self._threads += 1
+        elif speed < self._last_speed * 0.9 and self._threads > 1:
+            self._threads -= 1
+        self._last_speed = speed
+        self._round_start = now
+        self._round_bytes = self._round_chunks = self._round_retries = 0
+
+    @property
+    def speed(self):
+        "本次上传的平均速度，字节/秒"
+        return self._bytes / max(time.monotonic() - self._start, 1e-6)
+
+    def summary(self, fsize):
+        elapsed = time.monotonic() - self._start
+        return {
+            "bytes": self._bytes,
+            "time": elapsed,
+            "MB/s": self._bytes / 1048576 / max(elapsed, 1e-6),
+            "retries": self._retries,
+            "chunks": self._chunks,
+            "latency": self._latency,
+            "chunk_size": fsize,
+            "threads": self._threads
+            }
+
+_playurl_cache = TTLCache(ttl=60) #(cid, bvid, qn, 代理地址, SESSDATA, fnval)->playerUrl结果，视频地址有时效所以只缓存很短时间
+_proxy_choice = TTLCache(ttl=600) #(cid, bvid, SESSDATA, 代理地址, 是否强制代理)->实际使用的代理地址
+
+def _outPath(path, name):
+    "由保存目录和文件名得到保存路径"
+    if path != '':
+        if path[-1] == '/':
+            return f'{path}{name}'
+        return f'{path}/{name}'
+    return name
+
+def _playerUrl(biliapi, cid, bvid, qn, reverse_proxy, account, fnval=0):
+    "带缓存的playerUrl，只缓存成功的结果"
+    key = (cid, bvid, qn, reverse_proxy, account, fnval)
+    data = _playurl_cache.get(key)
+    if data is None:
+        data = biliapi.playerUrl(cid=cid, bvid=bvid, qn=qn, reverse_proxy=reverse_proxy, fnval=fnval)
+        if data["code"] == 0:
+            _playurl_cache.set(key, data)
+    return data
+
 class VideoDownloader(object):
     '''B站视频下载类'''
     class __videos(object):
@@ -184,35 +602,92 @@ class VideoDownloader(object):
             def __str__(self):
                 return f'filename={self._name} ; resolution={self._resolution} ; size={self._size / 1024 / 1024:0.2f}MB'
 
-            def download(self, path='', callback=None):
-                '''下载当前视频流'''
-                if path != '':
-                    if path[-1] == '/':
-                        path = f'{path}{self._name}'
-                    else:
-                        path = f'{path}/{self._name}'
-                else:
-                    path = self._name
+            def download(self, path='', callback=None, use_aria2=False, connections=8):
+                '''
+                下载当前视频流
+                use_aria2 bool 使用aria2下载，默认使用内置的分段下载器
+                connections int 内置下载器同时下载的分段数量
+                '''
+                if not use_aria2:
+                    asyncio.run(self.downloadAsync(path, callback, RangeDownloader(connections=connections)))
+                    return
 
                 aria2 = Aria2Py()
-                ret = aria2.addUri(self._url, {'max-connection-per-server':8,'referer': "https://www.bilibili.com","header":["User-Agent: Mozilla/5.0 (Windows NT 10.0; Win64; x64)"],'out':path})
+                ret = aria2.addUri(*self.aria2Task(path))
                 gid = ret["result"]
-                while aria2.tellStatus(gid, ["status","completedLength","totalLength"])["result"]["status"] == 'waiting':
-                    time.sleep(2)
-                while True:
-                    time.sleep(2)
-                    ret = aria2.tellStatus(gid, ["status","completedLength","totalLength"])["result"]
-                    if callback:
-                        if int(ret["totalLength"])!=0:
-                            callback(float(ret["completedLength"])/float(ret["totalLength"]))
-                    if ret["status"] != 'active':
-                        if ret["status"] != 'complete':
-                            raise Exception(f'下载失败(status: {ret["status"]})')
-                        break
+                status = aria2.waitDownloads([gid], callback)[gid] #等待aria2通知任务结束
+                if status != 'complete':
+                    raise Exception(f'下载失败(status: {status})')
+                if callback:
+                    callback(1)
+
+            def aria2Task(self, path=''):
+                '''
+                返回用aria2下载当前视频流的(链接, 附加参数)，可以传给Aria2Py.addUri，多个视频流可以用addUris一次添加
+                '''
+                return self._url, {'max-connection-per-server':8,'referer': "https://www.bilibili.com","header":["User-Agent: Mozilla/5.0 (Windows NT 10.0; Win64; x64)"],'out':_outPath(path, self._name)}
+
+            async def downloadAsync(self, path='', callback=None, downloader: RangeDownloader = None):
+                '''
+                使用内置的分段下载器下载当前视频流，返回文件路径
+                downloader RangeDownloader 下载器，多个下载共用时可以限制总连接数和带宽
+                '''
+                path = _outPath(path, self._name)
+                await (downloader or RangeDownloader()).download(self._url, path, self._size, callback)
+                return path
+
+        class __dashstream(object):
+            def __init__(self, name: str, video_url: str, audio_url: str, resolution: str, codecs: str, bandwidth: int, audio_bandwidth: int):
+                self._name = name
+                self._video_url = video_url
+                self._audio_url = audio_url
+                self._resolution = resolution
+                self._codecs = codecs
+                self._bandwidth = bandwidth
+                self._audio_bandwidth = audio_bandwidth
+
+            def __repr__(self):
+                return f'<name={self._name};resolution={self._resolution};codecs={self._codecs};bandwidth={self._bandwidth}>'
+
+            def __str__(self):
+                return f'filename={self._name} ; resolution={self._resolution} ; codecs={self._codecs} ; bitrate={(self._bandwidth + self._audio_bandwidth) / 1000:0.0f}kbps'
+
+            def download(self, path='', callback=None, connections=8):
+                '''
+                同时下载视频和音频，再合并为一个mp4文件(优先使用ffmpeg，没有ffmpeg时使用内置的合并)
+                connections int 视频和音频各自同时下载的分段数量
+                '''
+                asyncio.run(self.downloadAsync(path, callback, RangeDownloader(connections=connections)))
+
+            async def downloadAsync(self, path='', callback=None, downloader: RangeDownloader = None):
+                '''
+                download的异步版本，返回文件路径
+                downloader RangeDownloader 下载器，多个下载共用时可以限制总连接数和带宽
+                '''
+                path = _outPath(path, self._name)
+                downloader = downloader or RangeDownloader()
+                video_path = f'{path}.video.m4s'
+                audio_path = f'{path}.audio.m4s'
+                if not self._audio_url:
+                    await downloader.download(self._video_url, video_path, callback=callback)
+                    os.replace(video_path, path)
+                    return path
+
+                weight = self._bandwidth / max(self._bandwidth + self._audio_bandwidth, 1) #按码率估计视频占总进度的比例
+                progress = [0, 0]
+                def report(ii, per):
+                    progress[ii] = per
                     if callback:
-                        if int(ret["totalLength"])==0:
-                            continue
-                        callback(float(ret["completedLength"])/float(ret["totalLength"]))
+                        callback(progress[0] * weight + progress[1] * (1 - weight))
+
+                await asyncio.gather(
+                    downloader.download(self._video_url, video_path, callback=lambda x: report(0, x)),
+                    downloader.download(self._audio_url, audio_path, callback=lambda x: report(1, x))
+                    )
+                await asyncio.get_running_loop().run_in_executor(None, remux, video_path, audio_path, path) #合并文件较慢，不阻塞事件循环
+                os.remove(video_path)
+                os.remove(audio_path)
+                return path
 
         def __init__(self, subtitle, bvid='', cid=0, epid=''):
             self._title = subtitle.replace('/',' ')
@@ -229,47 +704,94 @@ class VideoDownloader(object):
             '''获取当前视频标题'''
             return self._title
 
-        def allStream(self, cookieData: dict = None, reverse_proxy='', force_use_proxy=False):
+        def allStream(self, cookieData: dict = None, reverse_proxy='', force_use_proxy=False, dash=False):
             '''
             获取所有视频流
             cookieData dict :包含"SESSDATA"值的字典，模拟用户登录
             reverse_proxy str :B站接口代理地址
             force_use_proxy bool :强制使用代理地址(默认请求失败才尝试代理地址)
+            dash bool :获取DASH视频流(视频音频分离，清晰度更高，一次请求即可得到所有清晰度)
             '''
             biliapi = bili()
+            account = ''
             if cookieData:
-                bili.login_by_cookie(cookieData)
+                requests.utils.add_dict_to_cookiejar(biliapi._session.cookies, cookieData) #解析视频流只需要cookie，不需要请求账户信息
+                account = cookieData.get("SESSDATA", '')
+
+            qn, fnval = (127, 16) if dash else (16, 0) #DASH请求最高清晰度，返回账户可用的所有清晰度
+            key = (self._cid, self._bvid, account, reverse_proxy, force_use_proxy)
+            RP = _proxy_choice.get(key) #同一视频同一账户是否使用代理只判断一次
+            if RP is not None:
+                data = _playerUrl(biliapi, self._cid, self._bvid, qn, RP, account, fnval)
+                if data["code"] != 0:
+                    RP = None
+            if RP is None:
+                RP, data = self.__chooseProxy(biliapi, reverse_proxy, force_use_proxy, account, qn, fnval)
+                _proxy_choice.set(key, RP)
+            if dash:
+                return self.__dashStreams(data["data"])
+            
+            accept_quality = data["data"]["accept_quality"]
+            accept_description = data["data"]["accept_description"]
+            with ThreadPoolExecutor(max_workers=max(1, len(accept_quality))) as executor: #同时请求所有清晰度
+                datas = list(executor.map(lambda qn: _playerUrl(biliapi, self._cid, self._bvid, qn, RP, account), accept_quality))
+            ret = []
+            for ii in range(len(accept_quality)):
+                if datas[ii]["code"] != 0:
+                    continue
+                data = datas[ii]["data"]
+                if data["quality"] != accept_quality[ii]:
+                    continue
+                if 'flv' in data["format"]:
+                    ret.append(self.__videostream(f'{self._title}.flv', data["durl"][0]["url"].replace('http:','https:'),accept_description[ii],data["durl"][0]["size"]))
+                else:
+                    ret.append(self.__videostream(f'{self._title}.mp4', data["durl"][0]["url"].replace('http:','https:'),accept_description[ii],data["durl"][0]["size"]))
+            return ret
+
+        def __dashStreams(self, data):
+            '''由DASH格式的playerUrl结果生成视频流列表，每个清晰度一个，优先选择兼容性最好的AVC编码，搭配码率最高的音频'''
+            if not 'dash' in data:
+                raise Exception('解析失败，该视频没有DASH视频流')
+            description = dict(zip(data["accept_quality"], data["accept_description"]))
+            audios = data["dash"].get("audio") or []
+            audio = max(audios, key=lambda x: x["bandwidth"]) if audios else None
+            ret = []
+            quality = set()
+            for x in sorted(data["dash"]["video"], key=lambda x: (-x["id"], x.get("codecid") != 7)):
+                if x["id"] in quality:
+                    continue
+                quality.add(x["id"])
+                ret.append(self.__dashstream(
+                    f'{self._title}.mp4',
+                    (x.get("baseUrl") or x["base_url"]).replace('http:','https:'),
+                    (audio.get("baseUrl") or audio["base_url"]).replace('http:','https:') if audio else '',
+                    description.get(x["id"], str(x["id"])),
+                    x.get("codecs", ''),
+                    x["bandwidth"],
+                    audio["bandwidth"] if audio else 0
+                    ))
+            return ret
 
+        def __chooseProxy(self, biliapi, reverse_proxy, force_use_proxy, account, qn=16, fnval=0):
+            '''判断是否需要使用代理，返回(代理地址, playerUrl结果)'''
             if force_use_proxy:
                 RP = reverse_proxy
-                data = biliapi.playerUrl(cid=self._cid, bvid=self._bvid, reverse_proxy=RP)
+                data = _playerUrl(biliapi, self._cid, self._bvid, qn, RP, account, fnval)
                 if data["code"] != 0:
                     raise Exception(f'解析失败，请尝试使用会员账号(错误信息：{data["message"]})')
             else:
                 RP = ''
-                data = biliapi.playerUrl(cid=self._cid, bvid=self._bvid, reverse_proxy=RP)
+                data = _playerUrl(biliapi, self._cid, self._bvid, qn, RP, account, fnval)
                 if data["code"] != 0:
                     if reverse_proxy == '':
                         raise Exception(f'解析失败，请尝试使用代理或会员账号(错误信息：{data["message"]})')
                     else:
                         RP = reverse_proxy
-                        data = biliapi.playerUrl(cid=self._cid, bvid=self._bvid, reverse_proxy=RP)
+                        data = _playerUrl(biliapi, self._cid, self._bvid, qn, RP, account, fnval)
                         if data["code"] != 0:
                             print(self._bvid, self._cid)
                             raise Exception(f'解析失败，请尝试更换代理地区或使用会员账号(错误信息：{data["message"]})')
-            
-            accept_quality = data["data"]["accept_quality"]
-            accept_description = data["data"]["accept_description"]
-            ret = []
-            for ii in range(len(accept_quality)):
-                data = biliapi.playerUrl(cid=self._cid, bvid=self._bvid, qn=accept_quality[ii], reverse_proxy=RP)["data"]
-                if data["quality"] != accept_quality[ii]:
-                    continue
-                if 'flv' in data["format"]:
-                    ret.append(self.__videostream(f'{self._title}.flv', data["durl"][0]["url"].replace('http:','https:'),accept_description[ii],data["durl"][0]["size"]))
-                else:
-                    ret.append(self.__videostream(f'{self._title}.mp4', data["durl"][0]["url"].replace('http:','https:'),accept_description[ii],data["durl"][0]["size"]))
-            return ret
+            return RP, data
 
     def __init__(self, url: str):
         self.set(url)
@@ -4,13 +4,27 @@ __version__ = '1.0.0'
 from .asyncBiliApi import asyncBiliApi as asyncbili
 from .BiliApi import BiliApi as bili
 from .Manga import MangaDownloader as MangaDownloader
+from .Manga import AsyncMangaDownloader as AsyncMangaDownloader
 from .Video import VideoUploader as VideoUploader
 from .Video import VideoDownloader as VideoDownloader
+from .ratelimit import TokenBucket as TokenBucket
+from .ratelimit import HostRateLimiter as HostRateLimiter
+from .cache import AsyncCache as AsyncCache
+from .rangedownloader import RangeDownloader as RangeDownloader
+from .mangaexport import CbzWriter as CbzWriter
+from .mangaexport import PdfWriter as PdfWriter
 
 __all__ = (
     'asyncbili',
     "bili",
     "MangaDownloader",
+    "AsyncMangaDownloader",
     "VideoUploader",
-    "VideoDownloader"
+    "VideoDownloader",
+    "TokenBucket",
+    "HostRateLimiter",
+    "AsyncCache",
+    "RangeDownloader",
+    "CbzWriter",
+    "PdfWriter"
 )
\ No newline at end of file
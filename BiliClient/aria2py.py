@@ -1,4 +1,4 @@
-import json, time
+import json, time, asyncio
 import subprocess
 import os
 
@@ -16,6 +16,7 @@ class Aria2Py(object):
                  remote=False
                  ):
         self.server_uri = f'http://{host}:{port}/jsonrpc'
+        self.ws_uri = f'ws://{host}:{port}/jsonrpc'
         self.secret = secret
         import requests
         self.session = requests.session()
@@ -52,9 +53,9 @@ class Aria2Py(object):
         '''发送RPC请求'''
         return self.session.post(self.server_uri, data=data).json()
 
-    def getRPCBody(self, method, params=[]):
+    def getRPCBody(self, method, params=None, uid='14515821564dsfdvzxvdf'):
         '''创建RPC请求'''
-        uid = '14515821564dsfdvzxvdf'
+        params = list(params or []) #复制参数，避免插入token时修改调用者的列表
         if self.secret:
             params.insert(0, f'token:{self.secret}')
         j = json.dumps({
@@ -65,6 +66,24 @@ class Aria2Py(object):
         })
         return j
 
+    def getMultiCallBody(self, calls, uid='14515821564dsfdvzxvdf'):
+        '''创建system.multicall请求，token需要放在每个调用的参数里'''
+        token = [f'token:{self.secret}'] if self.secret else []
+        return json.dumps({
+            'jsonrpc': '2.0',
+            'id': uid,
+            'method': 'system.multicall',
+            'params': [[{'methodName': method, 'params': token + list(params)} for method, params in calls]]
+        })
+
+    def multicall(self, calls):
+        '''
+        在一次请求中调用多个方法.
+        calls: list, [(方法名, 参数列表)].
+        return: 结果中每个调用成功时为[返回值]，失败时为{"code", "message"}.
+        '''
+        return self.sendJsonRPC(data=self.getMultiCallBody(calls))
+
     def addUri(self, uris, options=None, position=None):
         '''
         添加一个HTTP(S)/FTP/BitTorrent Magnet下载任务.
@@ -79,6 +98,23 @@ class Aria2Py(object):
             params.append(position)
         return self.sendJsonRPC(data=self.getRPCBody('aria2.addUri', params))
 
+    def addUris(self, uris_list, options=None):
+        '''
+        用一次system.multicall请求添加多个下载任务.
+        uris_list: list, 每个任务的链接或链接数组.
+        options: dict或list, 所有任务共用的附加参数，或与uris_list一一对应的附加参数数组.
+        return: 结果中按顺序为每个任务的[GID]，失败时为{"code", "message"}.
+        '''
+        if not isinstance(options, list):
+            options = [options] * len(uris_list)
+        calls = []
+        for uris, option in zip(uris_list, options):
+            params = [uris if isinstance(uris, list) else [uris]]
+            if option:
+                params.append(option)
+            calls.append(('aria2.addUri', params))
+        return self.multicall(calls)
+
     def remove(self, gid):
         '''
         移除下载任务.
@@ -169,6 +205,74 @@ class Aria2Py(object):
         '''
         return self.sendJsonRPC(data=self.getRPCBody('aria2.getGlobalStat'))
 
+    async def waitForDownloads(self, gids, callback=None, interval=2):
+        '''
+        通过WebSocket接收aria2的通知，等待任务结束，不需要轮询.
+        gids: list, GID数组.
+        callback: function, 进度回调，参数为所有任务的总进度0-1，指定时每interval秒查询一次进度.
+        return: dict, GID->结束时的状态(complete, error或removed).
+        gids中有aria2里不存在的任务时抛出异常.
+        '''
+        from aiohttp import ClientSession, WSMsgType
+        events = {
+            'aria2.onDownloadComplete': 'complete',
+            'aria2.onBtDownloadComplete': 'complete',
+            'aria2.onDownloadError': 'error',
+            'aria2.onDownloadStop': 'removed'
+            }
+        pending = set(gids)
+        result = {}
+        async with ClientSession() as session:
+            async with session.ws_connect(self.ws_uri) as ws:
+                async def query():
+                    await ws.send_str(self.getMultiCallBody([('aria2.tellStatus', [gid, ["gid", "status", "completedLength", "totalLength"]]) for gid in gids], uid='status'))
+                await query() #连接后先查询一次，连接前已经结束的任务不会再有通知
+                seeded = False
+                deadline = time.monotonic() + interval
+                while pending:
+                    try:
+                        msg = await asyncio.wait_for(ws.receive(), max(0, deadline - time.monotonic()) if callback else None)
+                    except asyncio.TimeoutError:
+                        await query()
+                        deadline = time.monotonic() + interval
+                        continue
+                    if msg.type != WSMsgType.TEXT:
+                        raise Exception('与aria2的连接已断开')
+                    data = json.loads(msg.data)
+                    if data.get("method") in events:
+                        for x in data["params"]:
+                            if x["gid"] in pending:
+                                pending.discard(x["gid"])
+                                result[x["gid"]] = events[data["method"]]
+                    elif data.get("id") == 'status':
+                        if 'error' in data:
+                            raise Exception(f'查询aria2任务状态失败({data["error"]["message"]})')
+                        unknown = [gid for gid, x in zip(gids, data["result"]) if not isinstance(x, list)]
+                        if unknown and not seeded:
+                            raise Exception(f'aria2中不存在任务{", ".join(unknown)}')
+                        seeded = True
+                        for gid in unknown: #等待时结果被清除的任务
+                            if gid in pending:
+                                pending.discard(gid)
+                                result[gid] = 'removed'
+                        status = [x[0] for x in data["result"] if isinstance(x, list)]
+                        for x in status:
+                            if x["gid"] in pending and x["status"] in ('complete', 'error', 'removed'):
+                                pending.discard(x["gid"])
+                                result[x["gid"]] = x["status"]
+                        if callback:
+                            total = sum(int(x["totalLength"]) for x in status)
+                            if total:
+                                callback(sum(int(x["completedLength"]) for x in status) / total)
+        return result
+
+    def waitDownloads(self, gids, callback=None, interval=2):
+        '''
+        waitForDownloads的同步版本.
+        gids: list, GID数组.
+        '''
+        return asyncio.run(self.waitForDownloads(gids, callback, interval))
+
     @staticmethod
     def isAria2Installed():
         '''Aria2是否已经安装'''
@@ -1,15 +1,112 @@
 # -*- coding: utf-8 -*-
-from aiohttp import ClientSession
+from aiohttp import ClientSession, CookieJar, TCPConnector, ClientTimeout, ClientConnectionError, ClientConnectorError
+from .util import backoff
+import asyncio, time, json
+
+class RetryableError(Exception):
+    '''可重试的请求错误(5xx、非json返回等)'''
+    pass
 
 class asyncBiliApi(object):
     '''B站异步接口类'''
-    def __init__(self):
+    def __init__(self, 
+                 connector: TCPConnector = None,
+                 rate_limiter: 'HostRateLimiter' = None,
+                 retries=3,
+                 retry_budget=10,
+                 timeout=30
+                 ):
+        '''
+        connector TCPConnector 共享的连接池，多个账户共用时每个账户仍有独立的cookie和csrf，为None时独占一个连接池
+        rate_limiter HostRateLimiter 共享的按域名限速器，为None时不限速
+        retries int 单次请求的最大重试次数
+        retry_budget int 每个接口在本对象生存期内的重试总次数，用完后该接口不再重试
+        timeout int 单次请求超时秒数
+        '''
 
         headers = {"User-Agent": "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 Chrome/63.0.3239.108","Referer": "https://www.bilibili.com/",'Connection': 'keep-alive'}
         self._islogin = False
+        self._bili_jct = ''
+        self._last_refresh = 0
         self._session = ClientSession(
-                headers = headers
+                headers = headers,
+                connector = connector,
+                connector_owner = connector is None, #共享连接池由创建者负责关闭
+                cookie_jar = CookieJar(),  #每个账户独立的cookie
+                trace_configs = [rate_limiter.createTraceConfig()] if rate_limiter else None,
+                timeout = ClientTimeout(total=timeout)
                 )
+        self._retries = retries
+        self._retry_budget_init = retry_budget
+        self._retry_budget = {} #接口地址->剩余重试次数
+
+    @staticmethod
+    def createConnector(limit=100, 
+                        limit_per_host=10
+                        ) -> TCPConnector:
+        '''
+        创建一个可供多个账户共享的连接池，需要在事件循环中调用
+        limit int 连接池总连接数上限
+        limit_per_host int 每个域名的连接数上限
+        '''
+        return TCPConnector(limit=limit, limit_per_host=limit_per_host, ttl_dns_cache=300)
+
+    async def _request(self, 
+                       method: str, 
+                       url: str, 
+                       idempotent: bool = None,
+                       **kwargs
+                       ) -> dict:
+        '''
+        所有接口共用的请求方法，返回解析后的json
+        连接失败(请求还没有发出)总是以带随机抖动的指数退避重试，
+        超时、连接中断、5xx、-412和非json返回只对幂等请求重试，非幂等的POST请求服务器可能已经执行了操作(付款、投币、转发等)
+        method str 请求方法
+        url str 请求地址
+        idempotent bool 是否可以安全重试，默认GET为True，POST为False，只读的POST接口需要显式指定
+        '''
+        if idempotent is None:
+            idempotent = method == 'GET'
+        endpoint = url.split('?', 1)[0]
+        if endpoint not in self._retry_budget:
+            self._retry_budget[endpoint] = self._retry_budget_init
+        attempt = 0
+        while True:
+            try:
+                async with self._session.request(method, url, ssl=False, **kwargs) as r:
+                    if r.status >= 500:
+                        raise RetryableError(f'服务器错误(HTTP {r.status})')
+                    try:
+                        ret = await r.json(content_type=None)
+                    except ValueError:
+                        raise RetryableError(f'返回内容不是json(HTTP {r.status})')
+                if not (isinstance(ret, dict) and ret.get("code") == -412):
+                    return ret
+                if not idempotent or attempt >= self._retries or self._retry_budget[endpoint] <= 0:
+                    return ret #请求被拦截且不能再重试时交给调用者处理
+            except ClientConnectorError:
+                if attempt >= self._retries or self._retry_budget[endpoint] <= 0:
+                    raise
+            except (RetryableError, asyncio.TimeoutError, ClientConnectionError):
+                if not idempotent or attempt >= self._retries or self._retry_budget[endpoint] <= 0:
+                    raise
+            self._retry_budget[endpoint] -= 1
+            await asyncio.sleep(backoff(attempt))
+            attempt += 1
+
+    async def _get(self, 
+                   url: str, 
+                   **kwargs
+                   ) -> dict:
+        '''GET请求，见_request'''
+        return await self._request('GET', url, **kwargs)
+
+    async def _post(self, 
+                    url: str, 
+                    **kwargs
+                    ) -> dict:
+        '''POST请求，见_request'''
+        return await self._request('POST', url, **kwargs)
         
     async def login_by_cookie(self, cookieData) -> bool:
         '''
@@ -17,16 +114,31 @@ class asyncBiliApi(object):
         cookieData dict 账户cookie
         '''
         self._session.cookie_jar.update_cookies(cookieData)
-        ret = await self.getWebNav()
-        if ret["code"] != 0:
-            return False
-
-        self._islogin = True
         if 'bili_jct' in cookieData:
             self._bili_jct = cookieData["bili_jct"]
         else:
             self._bili_jct = ''
+        if not await self.refreshInfo():
+            return False
+
+        code = (await self.likeCv(7793107))["code"]
+        if code != 0 and code != 65006 and code != -404:
+            import warnings
+            warnings.warn(f'{self._name}:账号异常，请检查bili_jct参数是否有效或本账号是否被封禁')
 
+        return True
+
+    async def refreshInfo(self) -> bool:
+        '''
+        重新验证cookie并刷新账户信息(硬币、经验等)，不做csrf检查，适合常驻运行时定期调用
+        返回cookie是否有效
+        '''
+        ret = await self.getWebNav()
+        if ret["code"] != 0:
+            self._islogin = False
+            return False
+
+        self._islogin = True
         self._name = ret["data"]["uname"]
         self._uid = ret["data"]["mid"]
         self._vip = ret["data"]["vipType"]
@@ -34,14 +146,14 @@ class asyncBiliApi(object):
         self._verified = ret["data"]["mobile_verified"]
         self._coin = ret["data"]["money"]
         self._exp = ret["data"]["level_info"]["current_exp"]
-
-        code = (await self.likeCv(7793107))["code"]
-        if code != 0 and code != 65006 and code != -404:
-            import warnings
-            warnings.warn(f'{self._name}:账号异常，请检查bili_jct参数是否有效或本账号是否被封禁')
-
+        self._last_refresh = time.time()
         return True
 
+    @property
+    def lastRefresh(self) -> float:
+        '''上次验证cookie的时间戳'''
+        return self._last_refresh
+
     @property
     def islogin(self):
         '''是否登录'''
@@ -75,16 +187,12 @@ class asyncBiliApi(object):
     async def getWebNav(self) -> dict:
         '''取导航信息'''
         url = "https://api.bilibili.com/x/web-interface/nav"
-        async with self._session.get(url, verify_ssl=False) as r:
-            ret = await r.json()
-        return ret
+        return await self._get(url)
 
     async def getReward(self) -> dict:
         '''取B站经验信息'''
         url = "https://account.bilibili.com/home/reward"
-        async with self._session.get(url, verify_ssl=False) as r:
-            ret = await r.json()
-        return ret
+        return await self._get(url)
     
     async def likeCv(self, 
                      cvid: int, 
@@ -100,9 +208,7 @@ class asyncBiliApi(object):
             "type": type,
             "csrf": self._bili_jct
             }
-        async with self._session.post(url, data=post_data, verify_ssl=False) as r:
-            ret = await r.json()
-        return ret
+        return await self._post(url, data=post_data)
 
     async def vipPrivilegeReceive(self, type=1) -> dict:
         '''领取B站大会员权益'''
@@ -111,9 +217,7 @@ class asyncBiliApi(object):
             "type": type,
             "csrf": self._bili_jct
             }
-        async with self._session.post(url, data=post_data, verify_ssl=False) as r:
-            ret = await r.json()
-        return ret
+        return await self._post(url, data=post_data)
 
     async def getUserWallet(self, platformType=3) -> dict:
         '''获取账户钱包信息'''
@@ -121,9 +225,7 @@ class asyncBiliApi(object):
         post_data = {
             "platformType": platformType
             }
-        async with self._session.post(url, data=post_data, verify_ssl=False) as r:
-            ret = await r.json()
-        return ret
+        return await self._post(url, data=post_data, idempotent=True)
 
     async def elecPay(self, uid: int, num=50) -> dict:
         '''
@@ -139,23 +241,17 @@ class asyncBiliApi(object):
             "oid": uid,
             "csrf": self._bili_jct
             }
-        async with self._session.post(url, data=post_data, verify_ssl=False) as r:
-            ret = await r.json()
-        return ret
+        return await self._post(url, data=post_data)
 
     async def xliveSign(self) -> dict:
         '''B站直播签到'''
         url = "https://api.live.bilibili.com/xlive/web-ucenter/v1/sign/DoSign"
-        async with self._session.get(url, verify_ssl=False) as r:
-            ret = await r.json()
-        return ret
+        return await self._get(url)
 
     async def xliveGetRecommendList(self) -> dict:
         '''B站直播获取首页前10条直播'''
         url = f'https://api.live.bilibili.com/relation/v1/AppWeb/getRecommendList'
-        async with self._session.get(url, verify_ssl=False) as r:
-            ret = await r.json()
-        return ret
+        return await self._get(url)
 
     async def xliveGetRoomInfo(self,
                                room_id: int) -> dict:
@@ -164,16 +260,12 @@ class asyncBiliApi(object):
         room_id int 房间id
         '''
         url = f'https://api.live.bilibili.com/xlive/web-room/v1/index/getInfoByRoom?room_id={room_id}'
-        async with self._session.get(url, verify_ssl=False) as r:
-            ret = await r.json()
-        return ret
+        return await self._get(url)
 
     async def xliveGiftBagList(self) -> dict:
         '''B站直播获取背包礼物'''
         url = 'https://api.live.bilibili.com/xlive/web-room/v1/gift/bag_list'
-        async with self._session.get(url, verify_ssl=False) as r:
-            ret = await r.json()
-        return ret
+        return await self._get(url)
 
     async def xliveBagSend(self,
                            biz_id,
@@ -211,9 +303,7 @@ class asyncBiliApi(object):
             "price": price,
             "csrf": self._bili_jct
             }
-        async with self._session.post(url, data=post_data, verify_ssl=False) as r:
-            ret = await r.json()
-        return ret
+        return await self._post(url, data=post_data)
 
     async def coin(self, 
              aid: int, 
@@ -233,8 +323,7 @@ class asyncBiliApi(object):
             "cross_domain": "true",
             "csrf": self._bili_jct
             }
-        async with self._session.post(url, data=post_data, verify_ssl=False) as r:
-            ret = await r.json()
+        ret = await self._post(url, data=post_data)
         return aid, ret
 
     async def report(self, 
@@ -254,9 +343,7 @@ class asyncBiliApi(object):
             "progres": progres,
             "csrf": self._bili_jct
             }
-        async with self._session.post(url, data=post_data, verify_ssl=False) as r:
-            ret = await r.json()
-        return ret
+        return await self._post(url, data=post_data)
 
     async def share(self, 
                     aid) -> dict:
@@ -269,16 +356,12 @@ class asyncBiliApi(object):
             "aid": aid,
             "csrf": self._bili_jct
             }
-        async with self._session.post(url, data=post_data, verify_ssl=False) as r:
-            ret = await r.json()
-        return ret
+        return await self._post(url, data=post_data)
 
     async def xliveGetStatus(self) -> dict:
         '''B站直播获取金银瓜子状态'''
         url = "https://api.live.bilibili.com/pay/v1/Exchange/getStatus"
-        async with self._session.get(url, verify_ssl=False) as r:
-            ret = await r.json()
-        return ret
+        return await self._get(url)
 
     async def silver2coin(self) -> dict:
         '''银瓜子兑换硬币'''
@@ -286,9 +369,7 @@ class asyncBiliApi(object):
         post_data = {
             "csrf_token": self._bili_jct
             }
-        async with self._session.post(url, data=post_data, verify_ssl=False) as r:
-            ret = await r.json()
-        return ret
+        return await self._post(url, data=post_data)
 
     async def getRegions(self, 
                          rid=1, 
@@ -299,9 +380,7 @@ class asyncBiliApi(object):
         num int 获取视频数量
         '''
         url = "https://api.bilibili.com/x/web-interface/dynamic/region?ps=" + str(num) + "&rid=" + str(rid)
-        async with self._session.get(url, verify_ssl=False) as r:
-            ret = await r.json()
-        return ret
+        return await self._get(url)
 
     async def mangaClockIn(self, 
                      platform="android") -> dict:
@@ -313,16 +392,12 @@ class asyncBiliApi(object):
         post_data = {
             "platform": platform
             }
-        async with self._session.post(url, data=post_data, verify_ssl=False) as r:
-            ret = await r.json()
-        return ret
+        return await self._post(url, data=post_data)
 
     async def mangaGetPoint(self) -> dict:
         '''获取漫画积分'''
         url = f'https://manga.bilibili.com/twirp/pointshop.v1.Pointshop/GetUserPoint'
-        async with self._session.post(url, json={}, verify_ssl=False) as r:
-            ret = await r.json()
-        return ret
+        return await self._post(url, json={}, idempotent=True)
 
     async def mangaShopExchange(self, 
                                 product_id: int, 
@@ -340,16 +415,12 @@ class asyncBiliApi(object):
             "point": point,
             "product_num": product_num
             }
-        async with self._session.post(url, json=post_data, verify_ssl=False) as r:
-            ret = await r.json()
-        return ret
+        return await self._post(url, json=post_data)
 
     async def mangaGetVipReward(self) -> dict:
         '''获取漫画大会员福利'''
         url = 'https://manga.bilibili.com/twirp/user.v1.User/GetVipReward'
-        async with self._session.post(url, json={"reason_id":1}, verify_ssl=False) as r:
-            ret = await r.json()
-        return ret
+        return await self._post(url, json={"reason_id":1})
 
     async def mangaComrade(self, 
                            platform="web") -> dict:
@@ -358,9 +429,7 @@ class asyncBiliApi(object):
         platform str 平台
         '''
         url = f'https://manga.bilibili.com/twirp/activity.v1.Activity/Comrade?platform={platform}'
-        async with self._session.post(url, json={}, verify_ssl=False) as r:
-            ret = await r.json()
-        return ret
+        return await self._post(url, json={}, idempotent=True)
 
     async def mangaPayBCoin(self, 
                             pay_amount: int, 
@@ -377,9 +446,7 @@ class asyncBiliApi(object):
             "pay_amount": pay_amount,
             "product_id": product_id
             }
-        async with self._session.post(url, json=post_data, verify_ssl=False) as r:
-            ret = await r.json()
-        return ret
+        return await self._post(url, json=post_data)
 
     async def mangaGetCoupons(self, 
                               not_expired=True, 
@@ -402,9 +469,7 @@ class asyncBiliApi(object):
             "page_size": page_size,
             "tab_type": tab_type
             }
-        async with self._session.post(url, json=post_data, verify_ssl=False) as r:
-            ret = await r.json()
-        return ret
+        return await self._post(url, json=post_data, idempotent=True)
 
     async def mangaListFavorite(self, 
                                 page_num=1, 
@@ -427,9 +492,7 @@ class asyncBiliApi(object):
             "order": order,
             "wait_free": wait_free
             }
-        async with self._session.post(url, json=post_data, verify_ssl=False) as r:
-            ret = await r.json()
-        return ret
+        return await self._post(url, json=post_data, idempotent=True)
 
     async def mangaDetail(self, 
                           comic_id: int, 
@@ -445,9 +508,49 @@ class asyncBiliApi(object):
         post_data = {
             "comic_id": comic_id
             }
-        async with self._session.post(url, json=post_data, verify_ssl=False) as r:
-            ret = await r.json()
-        return ret
+        return await self._post(url, json=post_data, idempotent=True)
+
+    async def mangaImageIndex(self, 
+                              ep_id: int, 
+                              device='pc', 
+                              platform='web') -> dict:
+        '''
+        获取漫画章节的图片列表
+        ep_id int 漫画章节id
+        device str 设备
+        platform str 平台
+        '''
+        url = f'https://manga.bilibili.com/twirp/comic.v1.Comic/GetImageIndex?device={device}&platform={platform}'
+        post_data = {
+            "ep_id": ep_id
+            }
+        return await self._post(url, json=post_data, idempotent=True)
+
+    async def mangaImageToken(self, 
+                              urls: list, 
+                              device='pc', 
+                              platform='web') -> dict:
+        '''
+        获取漫画图片token
+        urls list 图片路径列表(mangaImageIndex返回的path)
+        device str 设备
+        platform str 平台
+        '''
+        url = f'https://manga.bilibili.com/twirp/comic.v1.Comic/ImageToken?device={device}&platform={platform}'
+        post_data = {
+            "urls": json.dumps(urls)
+            }
+        return await self._post(url, json=post_data, idempotent=True)
+
+    async def mangaGetImageBytes(self, 
+                                 url: str) -> bytes:
+        '''
+        获取漫画图片，返回图片内容
+        url str 带token的图片地址
+        '''
+        async with self._session.get(url, ssl=False, trace_request_ctx={"rate_limit": False}) as r: #图片来自CDN，不占用接口的限速
+            r.raise_for_status()
+            return await r.read()
 
     async def mangaGetEpisodeBuyInfo(self, 
                                ep_id: int, 
@@ -461,9 +564,7 @@ class asyncBiliApi(object):
         post_data = {
             "ep_id": ep_id
             }
-        async with self._session.post(url, json=post_data, verify_ssl=False) as r:
-            ret = await r.json()
-        return ret
+        return await self._post(url, json=post_data, idempotent=True)
 
     async def mangaBuyEpisode(self, 
                         ep_id: int, 
@@ -489,9 +590,7 @@ class asyncBiliApi(object):
         if auto_pay_gold_status:
             post_data["auto_pay_gold_status"] = auto_pay_gold_status
 
-        async with self._session.post(url, json=post_data, verify_ssl=False) as r:
-            ret = await r.json()
-        return ret
+        return await self._post(url, json=post_data)
 
     async def activityAddTimes(self, 
                                sid: str, 
@@ -507,9 +606,7 @@ class asyncBiliApi(object):
             "action_type": action_type,
             "csrf": self._bili_jct
             }
-        async with self._session.post(url, data=post_data, verify_ssl=False) as r:
-            ret = await r.json()
-        return ret
+        return await self._post(url, data=post_data)
 
     async def activityDo(self, 
                          sid: str, 
@@ -525,9 +622,7 @@ class asyncBiliApi(object):
             "type": type,
             "csrf": self._bili_jct
             }
-        async with self._session.post(url, data=post_data, verify_ssl=False) as r:
-            ret = await r.json()
-        return ret
+        return await self._post(url, data=post_data)
 
     async def activityMyTimes(self, 
                               sid: str
@@ -537,24 +632,20 @@ class asyncBiliApi(object):
         sid str 活动的id
         '''
         url = f'https://api.bilibili.com/x/activity/lottery/mytimes?sid={sid}'
-        async with self._session.get(url, verify_ssl=False) as r:
-            ret = await r.json()
-        return ret
+        return await self._get(url)
 
     async def getDynamic(self, 
                          type_list=268435455
                          ) -> dict:
         '''取B站用户动态数据'''
-        async with self._session.get(f'https://api.vc.bilibili.com/dynamic_svr/v1/dynamic_svr/dynamic_new?uid={self._uid}&type_list={type_list}', verify_ssl=False) as r:
-            ret = await r.json()
+        ret = await self._get(f'https://api.vc.bilibili.com/dynamic_svr/v1/dynamic_svr/dynamic_new?uid={self._uid}&type_list={type_list}')
         cards = ret["data"]["cards"]
         for x in cards:
             yield x
         hasnext = True
         offset = cards[-1]["desc"]["dynamic_id"]
         while hasnext:
-            async with self._session.get(f'https://api.vc.bilibili.com/dynamic_svr/v1/dynamic_svr/dynamic_history?uid={self._uid}&offset_dynamic_id={offset}&type={type_list}', verify_ssl=False) as r:
-                ret = await r.json()
+            ret = await self._get(f'https://api.vc.bilibili.com/dynamic_svr/v1/dynamic_svr/dynamic_history?uid={self._uid}&offset_dynamic_id={offset}&type={type_list}')
             hasnext = (ret["data"]["has_more"] == 1)
             #offset = ret["data"]["next_offset"]
             cards = ret["data"]["cards"]
@@ -570,9 +661,7 @@ class asyncBiliApi(object):
         dynamic_id int 动态id
         '''
         url = f'https://api.vc.bilibili.com/dynamic_svr/v1/dynamic_svr/get_dynamic_detail?dynamic_id={dynamic_id}'
-        async with self._session.get(url, verify_ssl=False) as r:
-            ret = await r.json()
-        return ret
+        return await self._get(url)
 
     async def dynamicReplyAdd(self, 
                               oid: int, 
@@ -595,9 +684,7 @@ class asyncBiliApi(object):
             "message": message,
             "csrf": self._bili_jct
             }
-        async with self._session.post(url, data=post_data, verify_ssl=False) as r:
-            ret = await r.json()
-        return ret
+        return await self._post(url, data=post_data)
 
     async def dynamicRepostReply(self, 
                                  rid: int, 
@@ -627,9 +714,7 @@ class asyncBiliApi(object):
             "from": From,
             "csrf_token": self._bili_jct
             }
-        async with self._session.post(url, data=post_data, verify_ssl=False) as r:
-            ret = await r.json()
-        return ret
+        return await self._post(url, data=post_data)
 
     async def getMyDynamic(self, 
                            uid=0
@@ -644,8 +729,7 @@ class asyncBiliApi(object):
         hasnext = True
         offset = ''
         while hasnext:
-            async with self._session.get(f'{url}{offset}', verify_ssl=False) as r:
-                ret = await r.json()
+            ret = await self._get(f'{url}{offset}')
             hasnext = (ret["data"]["has_more"] == 1)
             if not 'cards' in ret["data"]:
                 continue
@@ -666,9 +750,7 @@ class asyncBiliApi(object):
             "dynamic_id": dynamic_id,
             "csrf_token": self._bili_jct
             }
-        async with self._session.post(url, data=post_data, verify_ssl=False) as r:
-            ret = await r.json()
-        return ret
+        return await self._post(url, data=post_data)
 
     async def getLotteryNotice(self, 
                                dynamic_id: int
@@ -678,18 +760,14 @@ class asyncBiliApi(object):
         dynamic_id int 抽奖动态id
         '''
         url = f'https://api.vc.bilibili.com/lottery_svr/v1/lottery_svr/lottery_notice?dynamic_id={dynamic_id}'
-        async with self._session.get(url, verify_ssl=False) as r:
-            ret = await r.json()
-        return ret
+        return await self._get(url)
 
     async def juryInfo(self) -> dict:
         '''
         取当前账户风纪委员状态
         '''
         url = 'https://api.bilibili.com/x/credit/jury/jury'
-        async with self._session.get(url, verify_ssl=False) as r:
-            ret = await r.json()
-        return ret
+        return await self._get(url)
 
     async def juryCaseObtain(self) -> dict:
         '''
@@ -699,9 +777,7 @@ class asyncBiliApi(object):
         post_data = {
             "csrf": self._bili_jct
             }
-        async with self._session.post(url, data=post_data, verify_ssl=False) as r:
-            ret = await r.json()
-        return ret
+        return await self._post(url, data=post_data)
 
     async def juryVote(self,
                        cid: int,
@@ -758,9 +834,7 @@ class asyncBiliApi(object):
             "csrf": self._bili_jct,
             **kwargs #所有可选参数
             }
-        async with self._session.post(url, data=post_data, verify_ssl=False) as r:
-            ret = await r.json()
-        return ret
+        return await self._post(url, data=post_data)
 
     async def __aenter__(self) -> 'aioBiliClient':
         return self
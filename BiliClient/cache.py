@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+import asyncio, time, threading
+from collections import OrderedDict
+
+_MISSING = object()
+
+class TTLCache(object):
+    '''
+    线程安全的同步缓存，每个key有自己的过期时间，超过容量时淘汰最久未使用的key，
+    供在线程中运行的同步代码(如Video.allStream)使用，也是AsyncCache的存储
+    '''
+    def __init__(self,
+                 maxsize=1024,
+                 ttl=300
+                 ):
+        '''
+        maxsize int 最多缓存的key数量
+        ttl float 默认过期秒数
+        '''
+        self._maxsize = maxsize
+        self._ttl = ttl
+        self._data = OrderedDict() #key->(过期时间, 值)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return self.get(key, _MISSING) is not _MISSING
+
+    def get(self, key, default=None):
+        '''取得key对应的值，不存在或过期时返回default'''
+        with self._lock:
+            item = self._data.get(key)
+            if item:
+                if item[0] > time.monotonic():
+                    self._data.move_to_end(key)
+                    return item[1]
+                del self._data[key]
+            return default
+
+    def set(self,
+            key,
+            value,
+            ttl: float = None
+            ) -> None:
+        '''
+        设置key对应的值
+        ttl float 本key的过期秒数，默认为创建时的ttl
+        '''
+        with self._lock:
+            self._data[key] = (time.monotonic() + (self._ttl if ttl is None else ttl), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self._maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self) -> None:
+        '''清空缓存'''
+        with self._lock:
+            self._data.clear()
+
+class AsyncCache(object):
+    '''
+    异步缓存，每个key有自己的过期时间，超过容量时淘汰最久未使用的key，
+    同一个key同时只会有一个请求在进行，其他调用者等待这个请求的结果
+    '''
+    def __init__(self,
+                 maxsize=1024,
+                 ttl=300
+                 ):
+        '''
+        maxsize int 最多缓存的key数量
+        ttl float 默认过期秒数
+        '''
+        self._data = TTLCache(maxsize, ttl)
+        self._pending = {} #key->正在进行的请求的Future
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    async def get(self,
+                  key,
+                  func,
+                  *args,
+                  ttl: float = None,
+                  cache_if=None,
+                  **kwargs):
+        '''
+        取得key对应的值，不存在或过期时调用await func(*args, **kwargs)取得并缓存
+        key 可哈希对象
+        func 异步函数
+        ttl float 本key的过期秒数，默认为创建时的ttl
+        cache_if function 判断结果是否可以缓存，返回False时只返回结果不缓存，默认全部缓存
+        '''
+        value = self._data.get(key, _MISSING)
+        if value is not _MISSING:
+            return value
+
+        pending = self._pending.get(key)
+        if pending: #已经有相同的请求在进行
+            await asyncio.wait([pending]) #调用者被取消时只取消自己的等待，不影响请求
+            if not pending.cancelled():
+                return pending.result()
+            #发起请求的调用者被取消，等待者重新发起请求，其中第一个成为新的请求者
+            return await self.get(key, func, *args, ttl=ttl, cache_if=cache_if, **kwargs)
+
+        future = asyncio.get_running_loop().create_future()
+        self._pending[key] = future
+        try:
+            value = await func(*args, **kwargs)
+        except BaseException as e:
+            if isinstance(e, Exception):
+                future.set_exception(e)
+                future.exception() #没有其他等待者时避免asyncio报告异常未被处理
+            else:
+                future.cancel()
+            raise
+        finally:
+            del self._pending[key]
+
+        future.set_result(value)
+        if cache_if is None or cache_if(value):
+            self.set(key, value, ttl)
+        return value
+
+    def set(self,
+            key,
+            value,
+            ttl: float = None
+            ) -> None:
+        '''
+        设置key对应的值
+        ttl float 本key的过期秒数，默认为创建时的ttl
+        '''
+        self._data.set(key, value, ttl)
+
+    def clear(self) -> None:
+        '''清空缓存'''
+        self._data.clear()
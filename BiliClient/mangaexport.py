@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+import struct, zipfile
+
+def jpegInfo(data: bytes) -> tuple:
+    '''
+    从JPEG的SOF段中读取图片信息，返回(宽, 高, 颜色通道数, 是否为Adobe格式)
+    data bytes JPEG图片
+    '''
+    if data[:2] != b'\xff\xd8':
+        raise ValueError('不是JPEG图片')
+    adobe = False
+    pos = 2
+    while pos + 4 <= len(data):
+        if data[pos] != 0xFF:
+            raise ValueError('JPEG图片格式错误')
+        marker = data[pos + 1]
+        if marker == 0xFF: #填充字节
+            pos += 1
+            continue
+        if marker == 0x01 or 0xD0 <= marker <= 0xD8: #没有长度的标记
+            pos += 2
+            continue
+        length = struct.unpack_from('>H', data, pos + 2)[0]
+        if marker == 0xEE and data[pos + 4:pos + 9] == b'Adobe':
+            adobe = True
+        if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC): #SOF0-SOF15，不包括DHT、JPG、DAC
+            bits, height, width, components = struct.unpack_from('>BHHB', data, pos + 4)
+            return width, height, components, adobe
+        pos += 2 + length
+    raise ValueError('JPEG图片格式错误(没有SOF)')
+
+class CbzWriter(object):
+    '''CBZ漫画文件，图片不压缩直接存入zip'''
+    def __init__(self, path: str):
+        '''
+        path str 保存路径
+        '''
+        self._zip = zipfile.ZipFile(path, 'w', zipfile.ZIP_STORED, allowZip64=True)
+
+    def addPage(self, filename: str, name: str) -> None:
+        '''
+        按顺序添加一页
+        filename str 图片文件路径
+        name str 在压缩包中的文件名，阅读器按文件名排序
+        '''
+        self._zip.write(filename, name)
+
+    def close(self) -> None:
+        self._zip.close()
+
+class PdfWriter(object):
+    '''边添加边写入的PDF文件，JPEG图片不重新编码，直接作为DCTDecode数据嵌入，每页大小与图片相同'''
+    _colorspaces = {1: '/DeviceGray', 3: '/DeviceRGB', 4: '/DeviceCMYK'}
+
+    def __init__(self, path: str, title: str = ''):
+        '''
+        path str 保存路径
+        title str PDF标题
+        '''
+        self._f = open(path, 'wb')
+        self._title = title
+        self._offsets = {} #对象编号->在文件中的位置
+        self._pages = [] #页面对象编号
+        self._next = 3 #1为Catalog，2为Pages，在最后写入
+        self._f.write(b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n')
+
+    def _object(self, body: bytes, stream: bytes = None) -> int:
+        num = self._next
+        self._next += 1
+        self._offsets[num] = self._f.tell()
+        self._f.write(f'{num} 0 obj\n'.encode() + body)
+        if stream is not None:
+            self._f.write(b'\nstream\n')
+            self._f.write(stream)
+            self._f.write(b'\nendstream')
+        self._f.write(b'\nendobj\n')
+        return num
+
+    def addPage(self, filename: str, name: str = '') -> None:
+        '''
+        按顺序添加一页，只支持JPEG图片
+        filename str 图片文件路径
+        '''
+        with open(filename, 'rb') as f:
+            data = f.read()
+        width, height, components, adobe = jpegInfo(data)
+        if components not in self._colorspaces:
+            raise ValueError(f'不支持的JPEG颜色通道数({components})')
+        decode = '/Decode[1 0 1 0 1 0 1 0]' if components == 4 and adobe else '' #Adobe的CMYK图片是反相存储的
+        image = self._object(f'<</Type/XObject/Subtype/Image/Width {width}/Height {height}/ColorSpace{self._colorspaces[components]}/BitsPerComponent 8/Filter/DCTDecode{decode}/Length {len(data)}>>'.encode(), data)
+        content = f'q {width} 0 0 {height} 0 0 cm /Im0 Do Q'.encode()
+        content = self._object(f'<</Length {len(content)}>>'.encode(), content)
+        self._pages.append(self._object(f'<</Type/Page/Parent 2 0 R/MediaBox[0 0 {width} {height}]/Resources<</XObject<</Im0 {image} 0 R>>>>/Contents {content} 0 R>>'.encode()))
+
+    def close(self) -> None:
+        '''写入页面目录和交叉引用表'''
+        kids = ' '.join(f'{x} 0 R' for x in self._pages)
+        self._offsets[2] = self._f.tell()
+        self._f.write(f'2 0 obj\n<</Type/Pages/Kids[{kids}]/Count {len(self._pages)}>>\nendobj\n'.encode())
+        self._offsets[1] = self._f.tell()
+        self._f.write(b'1 0 obj\n<</Type/Catalog/Pages 2 0 R>>\nendobj\n')
+        title = ('\ufeff' + self._title).encode('utf-16-be').hex() #标题使用UTF-16编码以支持中文
+        info = self._object(f'<</Title<{title}>>>'.encode())
+
+        xref = self._f.tell()
+        self._f.write(f'xref\n0 {self._next}\n0000000000 65535 f \n'.encode())
+        for num in range(1, self._next):
+            self._f.write(f'{self._offsets[num]:010d} 00000 n \n'.encode())
+        self._f.write(f'trailer\n<</Size {self._next}/Root 1 0 R/Info {info} 0 R>>\nstartxref\n{xref}\n%%EOF\n'.encode())
+        self._f.close()
@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+import shutil, struct, subprocess
+
+def _boxes(f, start: int, end: int):
+    '''遍历[start, end)范围内的box，返回(类型, box起始位置, 头部长度, box长度)'''
+    pos = start
+    while pos + 8 <= end:
+        f.seek(pos)
+        size, kind = struct.unpack('>I4s', f.read(8))
+        header = 8
+        if size == 1:
+            size = struct.unpack('>Q', f.read(8))[0]
+            header = 16
+        elif size == 0:
+            size = end - pos #最后一个box延续到文件末尾
+        if size < header:
+            raise ValueError(f'mp4文件格式错误(位置{pos})')
+        yield kind.decode('latin-1'), pos, header, size
+        pos += size
+
+def _children(data: bytes, offset: int = 8):
+    '''遍历内存中box的子box，返回(类型, 起始位置, 长度)'''
+    pos = offset
+    while pos + 8 <= len(data):
+        size, kind = struct.unpack_from('>I4s', data, pos)
+        if size < 8:
+            raise ValueError('mp4文件格式错误')
+        yield kind.decode('latin-1'), pos, size
+        pos += size
+
+def _box(kind: str, payload: bytes) -> bytes:
+    return struct.pack('>I4s', 8 + len(payload), kind.encode('latin-1')) + payload
+
+def _read(f, pos: int, size: int) -> bytes:
+    f.seek(pos)
+    return f.read(size)
+
+def _copy(src, dst, pos: int, size: int) -> None:
+    '''按块复制，mdat可能很大，不整体读入内存'''
+    src.seek(pos)
+    while size:
+        data = src.read(min(size, 1048576))
+        if not data:
+            raise ValueError('mp4文件不完整')
+        dst.write(data)
+        size -= len(data)
+
+def _setTrackId(trak: bytearray, track_id: int) -> None:
+    '''修改trak中tkhd的track_ID'''
+    for kind, pos, size in _children(trak):
+        if kind == 'tkhd':
+            version = trak[pos + 8]
+            struct.pack_into('>I', trak, pos + 12 + (16 if version == 1 else 8), track_id)
+            return
+    raise ValueError('mp4文件格式错误(没有tkhd)')
+
+def _getTrackId(trak: bytes) -> int:
+    for kind, pos, size in _children(trak):
+        if kind == 'tkhd':
+            version = trak[pos + 8]
+            return struct.unpack_from('>I', trak, pos + 12 + (16 if version == 1 else 8))[0]
+    raise ValueError('mp4文件格式错误(没有tkhd)')
+
+class _Track(object):
+    '''一个fMP4文件，记录moov中的trak、trex和所有片段的位置'''
+    def __init__(self, f):
+        self.f = f
+        self.ftyp = None
+        self.mvhd = None
+        self.traks = []
+        self.trexs = []
+        self.mehd = None
+        self.fragments = [] #(moof起始位置, moof长度, mdat起始位置, mdat长度)
+        end = f.seek(0, 2)
+        moof = None
+        for kind, pos, header, size in _boxes(f, 0, end):
+            if kind == 'ftyp':
+                self.ftyp = _read(f, pos, size)
+            elif kind == 'moov':
+                moov = _read(f, pos, size)
+                if header != 8:
+                    raise ValueError('不支持的moov格式')
+                for child, cpos, csize in _children(moov):
+                    data = bytearray(moov[cpos:cpos + csize])
+                    if child == 'mvhd':
+                        self.mvhd = data
+                    elif child == 'trak':
+                        self.traks.append(data)
+                    elif child == 'mvex':
+                        for x, xpos, xsize in _children(data):
+                            if x == 'trex':
+                                self.trexs.append(bytearray(data[xpos:xpos + xsize]))
+                            elif x == 'mehd':
+                                self.mehd = bytes(data[xpos:xpos + xsize])
+            elif kind == 'moof':
+                moof = (pos, size)
+            elif kind == 'mdat':
+                if moof is None:
+                    raise ValueError('不是分段的mp4文件(mdat前没有moof)')
+                self.fragments.append((moof[0], moof[1], pos, size))
+                moof = None
+            #sidx中的偏移在合并后失效，其他box也不需要，一并丢弃
+        if self.mvhd is None or not self.traks or not self.trexs:
+            raise ValueError('不是分段的mp4文件(没有mvex)')
+
+def _fixMoof(moof: bytearray, sequence: int, track_ids: dict, shift: int) -> None:
+    '''修改moof的序号和track_ID，显式指定的base_data_offset按移动的距离修正'''
+    for kind, pos, size in _children(moof):
+        if kind == 'mfhd':
+            struct.pack_into('>I', moof, pos + 12, sequence)
+        elif kind == 'traf':
+            for x, xpos, xsize in _children(moof[pos:pos + size]):
+                if x == 'tfhd':
+                    tfhd = pos + xpos
+                    flags = struct.unpack_from('>I', moof, tfhd + 8)[0] & 0xffffff
+                    old = struct.unpack_from('>I', moof, tfhd + 12)[0]
+                    struct.pack_into('>I', moof, tfhd + 12, track_ids.get(old, old))
+                    if flags & 0x000001: #base_data_offset是文件中的绝对位置
+                        base = struct.unpack_from('>Q', moof, tfhd + 16)[0]
+                        struct.pack_into('>Q', moof, tfhd + 16, base + shift)
+
+def mux(video_path: str, audio_path: str, out_path: str) -> None:
+    '''
+    把B站DASH的视频和音频(分段的mp4)合并为一个mp4文件，不需要ffmpeg
+    合并moov中的trak，重新编号音频的track_ID和所有moof的序号，丢弃sidx
+    video_path str 视频文件
+    audio_path str 音频文件
+    out_path str 输出文件
+    '''
+    with open(video_path, 'rb') as vf, open(audio_path, 'rb') as af, open(out_path, 'wb') as out:
+        video = _Track(vf)
+        audio = _Track(af)
+
+        next_id = max(_getTrackId(x) for x in video.traks) + 1
+        audio_ids = {} #音频原track_ID->新track_ID
+        for trak in audio.traks:
+            audio_ids[_getTrackId(trak)] = next_id
+            _setTrackId(trak, next_id)
+            next_id += 1
+        for trex in audio.trexs:
+            old = struct.unpack_from('>I', trex, 12)[0]
+            struct.pack_into('>I', trex, 12, audio_ids.get(old, old))
+
+        mvhd = bytearray(video.mvhd)
+        struct.pack_into('>I', mvhd, len(mvhd) - 4, next_id) #mvhd最后4字节为next_track_ID
+        mvex = _box('mvex', (video.mehd or b'') + b''.join(video.trexs) + b''.join(audio.trexs))
+        moov = _box('moov', bytes(mvhd) + b''.join(video.traks) + b''.join(audio.traks) + mvex)
+
+        out.write(video.ftyp or b'')
+        out.write(moov)
+        sequence = 1
+        for track, track_ids in ((video, {}), (audio, audio_ids)):
+            for moof_pos, moof_size, mdat_pos, mdat_size in track.fragments:
+                moof = bytearray(_read(track.f, moof_pos, moof_size))
+                _fixMoof(moof, sequence, track_ids, out.tell() - moof_pos)
+                out.write(moof)
+                _copy(track.f, out, mdat_pos, mdat_size)
+                sequence += 1
+
+def remux(video_path: str, audio_path: str, out_path: str) -> None:
+    '''合并视频和音频，优先使用ffmpeg，没有安装ffmpeg时使用mux'''
+    ffmpeg = shutil.which('ffmpeg')
+    if ffmpeg:
+        subprocess.run([ffmpeg, '-y', '-loglevel', 'error', '-i', video_path, '-i', audio_path, '-c', 'copy', out_path], check=True)
+    else:
+        mux(video_path, audio_path, out_path)
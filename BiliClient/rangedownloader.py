@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+from aiohttp import ClientSession, ClientTimeout, ClientError
+from .ratelimit import TokenBucket
+from .util import atomicWriteJson, backoff
+import asyncio, os, json, time
+
+DEFAULT_HEADERS = {
+    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64)",
+    "Referer": "https://www.bilibili.com"
+    }
+
+def _pwrite(fd: int, data: bytes, offset: int) -> None:
+    '''在文件指定位置写入，没有os.pwrite的平台(Windows)使用lseek+write，单线程事件循环中两步之间不会被打断'''
+    if hasattr(os, 'pwrite'):
+        while data:
+            n = os.pwrite(fd, data, offset)
+            data = data[n:]
+            offset += n
+    else:
+        os.lseek(fd, offset, os.SEEK_SET)
+        while data:
+            data = data[os.write(fd, data):]
+
+class RangeDownloader(object):
+    '''多连接分段下载器，用HTTP Range请求并行下载同一文件的多个分段，写入预先分配好大小的文件，支持断点续传'''
+    def __init__(self,
+                 connections=8,
+                 segment_size=4194304,
+                 retries=5,
+                 headers: dict = None,
+                 session: ClientSession = None,
+                 bucket: TokenBucket = None
+                 ):
+        '''
+        connections int 同时下载的分段数量
+        segment_size int 分段大小
+        retries int 每个分段失败后的重试次数
+        headers dict 请求头，默认带B站Referer
+        session ClientSession 共用的会话，不指定时每次下载创建新的会话，多个下载共用时由会话的连接池限制总连接数
+        bucket TokenBucket 以字节为令牌的限速器，多个下载共用时限制总带宽
+        '''
+        self._connections = connections
+        self._segment_size = segment_size
+        self._retries = retries
+        self._headers = headers or DEFAULT_HEADERS
+        self._session = session
+        self._bucket = bucket
+
+    async def download(self,
+                       url: str,
+                       path: str,
+                       size: int = 0,
+                       callback=None
+                       ) -> int:
+        '''
+        下载url到path，中断后再次下载同一路径会跳过已完成的分段，返回文件大小
+        url str 下载地址，B站的视频地址会过期，续传时可以使用新获取的地址
+        path str 保存路径
+        size int 文件大小，不指定时请求服务器获取
+        callback function 进度回调，参数为进度0-1
+        '''
+        if self._session:
+            return await self._download(self._session, url, path, size, callback)
+        async with ClientSession(headers=self._headers, timeout=ClientTimeout(total=None, sock_read=60)) as session:
+            return await self._download(session, url, path, size, callback)
+
+    async def _download(self, session: ClientSession, url, path, size, callback) -> int:
+        if not size:
+            size = await self._getSize(session, url)
+
+        statefile = f'{path}.download.json' #下载进度文件
+        state = self._loadState(statefile, path, size)
+        segments = range(0, size, state["segment_size"])
+        todo = asyncio.Queue()
+        for start in segments:
+            if start not in state["done"]:
+                todo.put_nowait(start)
+
+        done = set(state["done"])
+        progress = {"bytes": sum(min(state["segment_size"], size - x) for x in done), "time": 0}
+        def report(nbytes):
+            progress["bytes"] += nbytes
+            now = time.monotonic()
+            if callback and (now - progress["time"] > 0.5 or progress["bytes"] == size): #限制回调频率
+                progress["time"] = now
+                callback(progress["bytes"] / size if size else 1)
+
+        fd = os.open(path, os.O_RDWR | os.O_CREAT | getattr(os, 'O_BINARY', 0))
+        try:
+            if os.fstat(fd).st_size != size:
+                os.ftruncate(fd, size) #预先分配文件大小
+
+            async def worker():
+                while not todo.empty():
+                    start = todo.get_nowait()
+                    end = min(start + state["segment_size"], size) - 1
+                    await self._fetchSegment(session, url, fd, start, end, report)
+                    done.add(start)
+                    state["done"] = sorted(done)
+                    self._saveState(statefile, state)
+
+            workers = [asyncio.ensure_future(worker()) for ii in range(min(self._connections, todo.qsize()))]
+            try:
+                await asyncio.gather(*workers)
+            except BaseException:
+                for x in workers:
+                    x.cancel()
+                await asyncio.gather(*workers, return_exceptions=True)
+                raise
+        finally:
+            os.close(fd)
+
+        if os.path.exists(statefile):
+            os.remove(statefile) #下载完成后删除进度文件
+        if callback:
+            callback(1)
+        return size
+
+    async def _getSize(self, session: ClientSession, url) -> int:
+        '''请求第一个字节，从Content-Range中得到文件大小'''
+        for attempt in range(self._retries + 1):
+            try:
+                async with session.get(url, headers={**self._headers, "Range": "bytes=0-0"}) as r:
+                    if r.status == 206 and 'Content-Range' in r.headers:
+                        return int(r.headers["Content-Range"].rsplit('/', 1)[1])
+                    if r.status < 500:
+                        raise Exception(f'下载失败，服务器不支持分段下载(status: {r.status})')
+                    error = f'status: {r.status}'
+            except (ClientError, asyncio.TimeoutError) as e:
+                error = str(e)
+            if attempt < self._retries:
+                await asyncio.sleep(backoff(attempt)) #指数退避后重试
+        raise Exception(f'下载失败，无法取得文件大小({error})')
+
+    async def _fetchSegment(self, session: ClientSession, url, fd, start, end, report) -> None:
+        '''下载一个分段并写入文件，失败时从已写入的位置继续，只重试这个分段'''
+        offset = start
+        for attempt in range(self._retries + 1):
+            try:
+                async with session.get(url, headers={**self._headers, "Range": f'bytes={offset}-{end}'}) as r:
+                    if r.status != 206:
+                        raise ClientError(f'status: {r.status}')
+                    async for data in r.content.iter_chunked(65536):
+                        data = data[:end + 1 - offset] #防止服务器返回超出范围的数据
+                        if self._bucket:
+                            await self._bucket.acquire(len(data))
+                        _pwrite(fd, data, offset)
+                        offset += len(data)
+                        report(len(data))
+                if offset > end:
+                    return
+            except (ClientError, asyncio.TimeoutError) as e:
+                if attempt == self._retries:
+                    raise Exception(f'下载失败(bytes={start}-{end}，原因为{str(e)})')
+            if attempt < self._retries:
+                await asyncio.sleep(backoff(attempt)) #指数退避后重试
+        raise Exception(f'下载失败(bytes={start}-{end}，数据不完整)')
+
+    def _loadState(self, statefile, path, size) -> dict:
+        '''读取下载进度，文件大小不一致或没有进度文件时重新下载'''
+        try:
+            with open(statefile, 'r', encoding='utf-8') as fp:
+                state = json.load(fp)
+            if state["size"] == size and os.path.getsize(path) == size:
+                return state
+        except (OSError, ValueError, KeyError):
+            pass
+        return {"size": size, "segment_size": self._segment_size, "done": []}
+
+    @staticmethod
+    def _saveState(statefile, state) -> None:
+        '''保存下载进度'''
+        atomicWriteJson(statefile, state)
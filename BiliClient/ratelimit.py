@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+import asyncio, time
+from aiohttp import TraceConfig
+
+class TokenBucket(object):
+    '''异步令牌桶限速器'''
+    def __init__(self,
+                 rate: float,
+                 capacity: float = None
+                 ):
+        '''
+        rate float 每秒产生的令牌数量
+        capacity float 令牌桶容量(允许的突发数量)，默认与rate相同且不小于1
+        '''
+        self._rate = rate
+        self._capacity = capacity if capacity else max(rate, 1)
+        self._tokens = self._capacity
+        self._last = time.monotonic()
+        self._lock = None #在事件循环中第一次使用时创建
+
+    @property
+    def rate(self) -> float:
+        '''每秒产生的令牌数量'''
+        return self._rate
+
+    async def acquire(self, tokens=1) -> None:
+        '''
+        取得令牌，令牌不足时等待
+        tokens float 需要的令牌数量，大于桶容量时等桶满后透支
+        '''
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock: #保证先到先得
+            need = min(tokens, self._capacity)
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self._capacity, self._tokens + (now - self._last) * self._rate)
+                self._last = now
+                if self._tokens >= need:
+                    self._tokens -= tokens
+                    return
+                await asyncio.sleep((need - self._tokens) / self._rate)
+
+class HostRateLimiter(object):
+    '''按域名分别限速的令牌桶集合，所有账户共用'''
+    def __init__(self, rates: dict = None):
+        '''
+        rates dict 域名->每秒请求数，"default"为未列出域名的每秒请求数，不存在或为0时不限速
+        '''
+        rates = dict(rates) if rates else {}
+        self._default = rates.pop("default", 0)
+        self._rates = rates
+        self._buckets = {}
+
+    def _get_bucket(self, host: str) -> TokenBucket:
+        if host not in self._buckets:
+            rate = self._rates.get(host, self._default)
+            self._buckets[host] = TokenBucket(rate) if rate else None
+        return self._buckets[host]
+
+    async def acquire(self, host: str) -> None:
+        '''
+        等待指定域名的令牌
+        host str 域名
+        '''
+        bucket = self._get_bucket(host)
+        if bucket:
+            await bucket.acquire()
+
+    def createTraceConfig(self) -> TraceConfig:
+        '''
+        创建aiohttp的TraceConfig，使session的每个请求在发出前等待对应域名的令牌
+        请求时传入trace_request_ctx={"rate_limit": False}可以跳过限速(如图片CDN)
+        '''
+        async def on_request_start(session, trace_config_ctx, params):
+            ctx = trace_config_ctx.trace_request_ctx
+            if isinstance(ctx, dict) and ctx.get("rate_limit") is False:
+                return
+            await self.acquire(params.url.host)
+
+        trace_config = TraceConfig()
+        trace_config.on_request_start.append(on_request_start)
+        return trace_config
@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+import os, json, random
+
+def atomicWrite(filename: str, data: bytes) -> None:
+    '''
+    先写临时文件再替换，中断时不会留下不完整的文件
+    filename str 文件路径
+    data bytes 文件内容
+    '''
+    with open(f'{filename}.tmp', 'wb') as f:
+        f.write(data)
+    os.replace(f'{filename}.tmp', filename)
+
+def atomicWriteJson(filename: str, obj) -> None:
+    '''
+    以json格式原子写入文件，用于各种进度和记录文件
+    filename str 文件路径
+    obj 可以json序列化的对象
+    '''
+    atomicWrite(filename, json.dumps(obj, ensure_ascii=False).encode('utf-8'))
+
+def backoff(attempt: int, cap=30) -> float:
+    '''
+    第attempt次(从0开始)重试前等待的秒数，指数退避并在0到上限间随机(full jitter)，避免大量请求同时重试
+    cap float 等待时间上限
+    '''
+    return random.uniform(0, min(cap, 2 ** attempt))
@@ -1,8 +1,19 @@
 # -*- coding: utf-8 -*-
 import asyncio, json, time, logging, sys, re, io
+import logging.handlers, multiprocessing
 from getopt import getopt
-from BiliClient import asyncbili
+from BiliClient import asyncbili, HostRateLimiter
 import tasks
+from tasks import import_once
+from tasks.cron import CronTrigger
+
+DEFAULT_SCHEDULE = {
+    "default": "0 12 * * *", #常驻运行时任务默认在每天中午12点运行
+    "lottery_task": "30 12 * * *", #转发和删除动态有速率限制，需要运行较长时间，避开12点的任务
+    "clean_dynamic_task": "0 13 * * *",
+    "vip_task": "0 12 1,28 * *" #每月1号领取大会员权益，28号充电
+    }
+URGENT_TASKS = ("exchangeCoupons_task",) #需要准时运行的任务，不受max_concurrent_users限制
 
 def push_message(SCKEY=None,
                  email=None
@@ -19,39 +30,253 @@ def push_message(SCKEY=None,
         req = urllib.request.Request(url=f'http://liuxingw.com/api/mail/api.php?{data_string}', headers={"User-Agent":"Mozilla/5.0"})
         urllib.request.urlopen(req)
 
+def get_user_tasks(user: dict, 
+                   default: dict
+                   ) -> list:
+    '''根据默认配置和账户配置得到账户需要运行的任务列表[(任务名, 任务配置)]，没有配置的任务其配置为None'''
+    result = []
+    for task in default: #遍历任务列表，把需要运行的任务添加到result
+        if isinstance(default[task], bool):
+            if task in user["tasks"]:
+                if user["tasks"][task]:
+                    result.append((task, None))
+            elif default[task]:
+                result.append((task, None))
+        elif isinstance(default[task], dict):
+            if task in user["tasks"]:
+                if user["tasks"][task]["enable"]:
+                    result.append((task, user["tasks"][task]))
+            elif default[task]["enable"]:
+                result.append((task, default[task]))
+    return result
+
+def create_task(biliapi: asyncbili, 
+                task: str, 
+                task_config: dict
+                ) -> 'coroutine':
+    '''载入任务入口方法并创建任务'''
+    task_function = getattr(tasks, task)
+    if task_config is None:
+        return task_function(biliapi)
+    return task_function(biliapi, task_config)
+
 async def run_user_tasks(user,           #用户配置
-                        default          #默认配置
-                        ) -> None:
-    async with asyncbili() as biliapi:
+                        default,         #默认配置
+                        connector=None,  #共享连接池
+                        rate_limiter=None, #共享限速器
+                        request_options={}, #请求重试与超时设置
+                        semaphore=None,  #限制同时运行任务的账户数量
+                        urgent_tasks=()  #不受semaphore限制，登录后立即运行的任务
+                        ) -> bool:
+    '''运行一个账户的所有任务，返回账户是否登录成功'''
+    async with asyncbili(connector, rate_limiter, **request_options) as biliapi:
         try:
             if not await biliapi.login_by_cookie(user["cookieDatas"]):
                 logging.warning(f'id为{user["cookieDatas"]["DedeUserID"]}的账户cookie失效，跳过此账户后续操作')
-                return
+                return False
         except Exception as e: 
             logging.warning(f'登录验证id为{user["cookieDatas"]["DedeUserID"]}的账户失败，原因为{str(e)}，跳过此账户后续操作')
-            return
-
-        task_array = [] #存放本账户所有任务
-
-        for task in default: #遍历任务列表，把需要运行的任务添加到task_array
-            if isinstance(default[task], bool):
-                if task in user["tasks"]:
-                    if user["tasks"][task]:
-                        task_function = getattr(tasks, task)#载入任务入口方法
-                        task_array.append(task_function(biliapi))               #放进任务列表
-                elif default[task]:
-                    task_function = getattr(tasks, task)
-                    task_array.append(task_function(biliapi))
-            elif isinstance(default[task], dict):
-                if task in user["tasks"]:
-                    if user["tasks"][task]["enable"]:
-                        task_function = getattr(tasks, task)
-                        task_array.append(task_function(biliapi, user["tasks"][task]))
-                elif default[task]["enable"]:
-                    task_function = getattr(tasks, task)
-                    task_array.append(task_function(biliapi, default[task]))
+            return False
+
+        user_tasks = get_user_tasks(user, default)
+        urgent = [asyncio.ensure_future(create_task(biliapi, task, task_config)) for task, task_config in user_tasks if task in urgent_tasks]
+        task_array = [(task, task_config) for task, task_config in user_tasks if task not in urgent_tasks] #存放本账户其他任务
         if task_array:
-            await asyncio.wait(task_array)        #异步等待所有任务完成
+            if semaphore is None:
+                await asyncio.wait([asyncio.ensure_future(create_task(biliapi, *x)) for x in task_array])
+            else:
+                async with semaphore:
+                    await asyncio.wait([asyncio.ensure_future(create_task(biliapi, *x)) for x in task_array])
+        if urgent:
+            await asyncio.wait(urgent)        #异步等待所有任务完成
+        return True
+
+async def run_all_users(configData: dict) -> list:
+    '''
+    所有账户共用一个连接池和限速器运行任务，同时运行的账户数量受max_concurrent_users限制，urgent_tasks中的任务不受限制
+    返回每个账户的运行结果[(DedeUserID, 是否登录成功)]
+    '''
+    connector = asyncbili.createConnector(**configData.get("connection", {}))
+    rate_limiter = HostRateLimiter(configData.get("rate_limit"))
+    max_users = configData.get("max_concurrent_users", 0)
+    semaphore = asyncio.Semaphore(max_users) if max_users > 0 else None
+    request_options = configData.get("request", {})
+    urgent_tasks = set(configData.get("urgent_tasks", URGENT_TASKS))
+
+    try:
+        results = await asyncio.gather(*[run_user_tasks(user, configData["default"], connector, rate_limiter, request_options, semaphore, urgent_tasks) for user in configData["users"]], return_exceptions=True)
+    finally:
+        await connector.close()
+    return [(user["cookieDatas"].get("DedeUserID", ''), result is True) for user, result in zip(configData["users"], results)]
+
+def get_task_trigger(task: str, 
+                     task_config: dict, 
+                     schedule: dict
+                     ) -> CronTrigger:
+    '''
+    取得任务的定时器，优先使用schedule中的配置，
+    没有配置但任务有days参数时(漫画任务等)在每月的这些日期按默认时间运行
+    '''
+    if task in schedule:
+        return CronTrigger(schedule[task])
+    if task_config and task_config.get("days"):
+        minute, hour = schedule["default"].split()[:2]
+        return CronTrigger(f'{minute} {hour} {",".join(str(x) for x in task_config["days"])} * *')
+    return CronTrigger(schedule["default"])
+
+async def run_daemon(configData: dict) -> None:
+    '''
+    常驻运行，每个任务按自己的cron表达式独立定时运行，
+    账户保持登录状态和连接，cookie超过revalidate_interval秒才重新验证，
+    同时运行任务的账户数量受max_concurrent_users限制，urgent_tasks中的任务不受限制，到时间立即运行
+    '''
+    connector = asyncbili.createConnector(**configData.get("connection", {}))
+    rate_limiter = HostRateLimiter(configData.get("rate_limit"))
+    request_options = configData.get("request", {})
+    max_users = configData.get("max_concurrent_users", 0)
+    semaphore = asyncio.Semaphore(max_users) if max_users > 0 else None
+    schedule = dict(DEFAULT_SCHEDULE, **configData.get("schedule", {}))
+    urgent_tasks = set(configData.get("urgent_tasks", URGENT_TASKS))
+    revalidate_interval = configData.get("revalidate_interval", 3600)
+    is_push_message = bool(configData["email"] or configData["SCKEY"])
+    prewarm = 60 #提前验证cookie的秒数，保证任务准时运行
+
+    accounts = [{"user": user, 
+                 "biliapi": asyncbili(connector, rate_limiter, **request_options), 
+                 "login_lock": asyncio.Lock(), #同一账户的多个任务同时到时间时只验证一次
+                 "slot_lock": asyncio.Lock(),
+                 "running": 0 #正在运行的受限任务数量，大于0时占用一个账户名额
+                 } for user in configData["users"]]
+    jobs = [] #(账户, 任务名, 任务配置, 定时器)
+    for account in accounts:
+        for task, task_config in get_user_tasks(account["user"], configData["default"]):
+            jobs.append((account, task, task_config, get_task_trigger(task, task_config, schedule)))
+    running = [0] #所有账户正在运行的任务数量，全部结束后推送消息
+
+    async def check_login(account: dict) -> bool:
+        '''首次运行时登录，之后只在验证过期时刷新账户信息'''
+        biliapi = account["biliapi"]
+        uid = account["user"]["cookieDatas"]["DedeUserID"]
+        async with account["login_lock"]:
+            try:
+                if not biliapi.islogin:
+                    if not await biliapi.login_by_cookie(account["user"]["cookieDatas"]):
+                        logging.warning(f'id为{uid}的账户cookie失效，跳过此账户本次任务')
+                        return False
+                elif time.time() - biliapi.lastRefresh > revalidate_interval:
+                    if not await biliapi.refreshInfo():
+                        logging.warning(f'id为{uid}的账户cookie失效，跳过此账户本次任务')
+                        return False
+            except Exception as e: 
+                logging.warning(f'登录验证id为{uid}的账户失败，原因为{str(e)}，跳过此账户本次任务')
+                return False
+        return True
+
+    async def acquire_slot(account: dict) -> None:
+        '''账户的第一个受限任务开始时占用一个账户名额'''
+        async with account["slot_lock"]:
+            if account["running"] == 0 and semaphore:
+                await semaphore.acquire()
+            account["running"] += 1
+
+    def release_slot(account: dict) -> None:
+        '''账户的最后一个受限任务结束时释放账户名额'''
+        account["running"] -= 1
+        if account["running"] == 0 and semaphore:
+            semaphore.release()
+
+    async def run_job(account: dict, 
+                      task: str, 
+                      task_config: dict
+                      ) -> None:
+        urgent = task in urgent_tasks
+        if not urgent:
+            await acquire_slot(account)
+        try:
+            if await check_login(account):
+                await create_task(account["biliapi"], task, task_config)
+        except Exception as e:
+            logging.warning(f'id为{account["user"]["cookieDatas"]["DedeUserID"]}的账户运行{task}异常，原因为{str(e)}')
+        finally:
+            if not urgent:
+                release_slot(account)
+
+    async def schedule_job(account: dict, 
+                           task: str, 
+                           task_config: dict, 
+                           trigger: CronTrigger
+                           ) -> None:
+        '''按定时器循环运行一个账户的一个任务，与其他任务互不等待'''
+        while True:
+            next_time = trigger.next(time.time())
+            delay = next_time - time.time()
+            if delay > prewarm:
+                await asyncio.sleep(delay - prewarm)
+                await check_login(account)
+            await asyncio.sleep(max(0, next_time - time.time()))
+
+            import_once.refresh_time()
+            running[0] += 1
+            try:
+                await run_job(account, task, task_config)
+            finally:
+                running[0] -= 1
+            if running[0] == 0 and is_push_message and log_stream_io.getvalue():
+                try:
+                    push_message(configData["SCKEY"], configData["email"])
+                except Exception as e: 
+                    logging.error(f'消息推送异常，原因为{str(e)}')
+                log_stream_io.seek(0)
+                log_stream_io.truncate()
+
+    if not jobs:
+        logging.warning('没有需要运行的任务，退出常驻运行')
+    try:
+        await asyncio.gather(*[schedule_job(*job) for job in jobs])
+    finally:
+        for account in accounts:
+            await account["biliapi"].close()
+        await connector.close()
+
+def _init_shard_worker(log_queue) -> None:
+    '''子进程初始化，日志全部交给父进程输出'''
+    logger = logging.getLogger()
+    for handler in logger.handlers[:]:
+        logger.removeHandler(handler)
+    logger.setLevel(logging.INFO)
+    logger.addHandler(logging.handlers.QueueHandler(log_queue))
+
+def run_shard(configData: dict) -> list:
+    '''子进程入口，在独立的事件循环中运行分配到的账户'''
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        return loop.run_until_complete(run_all_users(configData))
+    finally:
+        loop.close()
+
+def run_sharded(configData: dict, 
+                processes: int
+                ) -> list:
+    '''
+    把账户平均分配到多个进程中运行，每个进程有自己的事件循环，日志汇总到本进程的日志输出
+    processes int 进程数量
+    '''
+    users = configData["users"]
+    processes = min(processes, len(users))
+    #限速和并发数按进程数均分，保证总体请求速率不变
+    rate_limit = {k: v / processes for k, v in configData.get("rate_limit", {}).items()}
+    max_users = -(-configData.get("max_concurrent_users", 0) // processes)
+    shards = [dict(configData, users=users[ii::processes], rate_limit=rate_limit, max_concurrent_users=max_users) for ii in range(processes)]
+    log_queue = multiprocessing.Queue()
+    listener = logging.handlers.QueueListener(log_queue, *logging.getLogger().handlers)
+    listener.start()
+    try:
+        with multiprocessing.Pool(processes, initializer=_init_shard_worker, initargs=(log_queue,)) as pool:
+            results = pool.map(run_shard, shards)
+    finally:
+        listener.stop()
+    return [x for shard in results for x in shard]
 
 def initlog(log_file: str, log_console: bool, log_stream: bool):
     '''初始化日志参数'''
@@ -97,9 +322,23 @@ def main(*args, **kwargs):
         print(f'日志配置异常，原因为{str(e)}')
 
     #启动任务
-    loop = asyncio.get_event_loop()
-    tasks = [asyncio.ensure_future(run_user_tasks(user, configData["default"])) for user in configData["users"]]
-    loop.run_until_complete(asyncio.wait(tasks))
+    if kwargs.get("daemon", False):
+        loop = asyncio.get_event_loop()
+        loop.run_until_complete(run_daemon(configData))
+        return
+
+    if 'processes' in kwargs:
+        processes = kwargs["processes"]
+    else:
+        processes = configData.get("processes", 1)
+    if processes > 1 and len(configData["users"]) > 1:
+        results = run_sharded(configData, processes)
+    else:
+        loop = asyncio.get_event_loop()
+        results = loop.run_until_complete(run_all_users(configData))
+    failed = [uid for uid, ok in results if not ok]
+    if failed:
+        logging.info(f'共{len(results)}个账户，{len(failed)}个账户登录失败(id为{",".join(failed)})')
 
     if is_push_message:
         try:
@@ -109,14 +348,18 @@ def main(*args, **kwargs):
 
 if __name__=="__main__":
     kwargs = {}
-    opts, args = getopt(sys.argv[1:], "hvc:l:",["configfile=","logfile="])
+    opts, args = getopt(sys.argv[1:], "hvdc:l:p:",["configfile=","logfile=","processes=","daemon"])
     for opt, arg in opts:
         if opt in ('-c','--configfile'):
             kwargs["config"] = arg
         elif opt in ('-l','--logfile'):
             kwargs["log"] = arg
+        elif opt in ('-p','--processes'):
+            kwargs["processes"] = int(arg)
+        elif opt in ('-d','--daemon'):
+            kwargs["daemon"] = True
         elif opt == '-h':
-            print('BliExp -c <configfile> -l <logfile>')
+            print('BliExp -c <configfile> -l <logfile> -p <processes> -d(常驻运行)')
             sys.exit()
         elif opt == '-v':
             print('BiliExp v1.0.0')
@@ -1,11 +1,13 @@
 # -*- coding: utf-8 -*-
-from BiliClient import MangaDownloader
-import json, re
+from BiliClient import MangaDownloader, CbzWriter, PdfWriter
+import os, json, re, logging
+
+logging.basicConfig(level=logging.INFO, format='%(message)s')
 
 id = int(input('请输入B站漫画id(整数，不带mc前缀)：'))
 path = input('请输入保存路径：')
 co = input('是否加载cookie以用户身份登录(y/n)：')
-pdf = input('下载后是否合并为一个pdf(需要安装pymupdf模块)(y/n)：')
+fmt = input('下载的同时导出为一个文件(pdf/cbz/n)：')
 
 path = path.replace('\\', '/')
 
@@ -16,25 +18,19 @@ if co.upper() == 'Y':
 else:
     mag = MangaDownloader(id)
 
-mag.downloadAll(path)
+title = mag.getTitle()
+comic_path = f'{path.rstrip("/")}/{title}'
+export = []
+if fmt.lower() in ('pdf', 'cbz'):
+    os.makedirs(comic_path, exist_ok=True)
+    filename = f'{comic_path}/{title}.{fmt.lower()}'
+    export.append(PdfWriter(filename, title) if fmt.lower() == 'pdf' else CbzWriter(filename)) #章节下载完成后按顺序写入，不需要等全部下载完再合并
+
+try:
+    mag.downloadAll(path, export=export)
+finally:
+    for writer in export:
+        writer.close()
 print('下载任务结束')
-
-if pdf.upper() == 'Y':
-    import fitz, glob
-    print("正在合并下载图片为pdf")
-    title = mag.getTitle()
-    if path[-1] == '/':
-        path = f'{path}{title}'
-    else:
-        path = fr'{path}/{title}'
-
-    doc = fitz.open()
-    for name in glob.glob(f'{path}/*/*.jpg'):
-        imgdoc = fitz.open(name)
-        pdfbytes = imgdoc.convertToPDF()
-        imgpdf = fitz.open("pdf", pdfbytes)
-        doc.insertPDF(imgpdf)
-    doc.save(f'{path}/{title}.pdf')
-    print(f'文件保存至{path}/{title}.pdf')
-
-
+if export:
+    print(f'文件保存至{filename}')
@@ -1,47 +1,101 @@
-from BiliClient import asyncbili
-import logging, json
-from .import_once import now_time
+from BiliClient import asyncbili, TokenBucket
+import logging, json, asyncio
+from . import import_once
+from .keyword_matcher import get_matcher
+
+def _decode(x: dict) -> tuple:
+    '''解析一条动态的card和origin，每条动态只解析一次，返回(card, origin)'''
+    card = json.loads(x["card"])
+    origin = json.loads(card["origin"]) if 'origin' in card else None
+    return card, origin
+
+def _check_local(card: dict) -> str:
+    '''不需要请求接口的检查，返回删除原因，不需要删除返回None'''
+    if 'item' in card and 'miss' in card["item"] and card["item"]["miss"] == 1:
+        return '动态已被原作者删除'
+
+    if 'origin_extension' in card and 'lott' in card["origin_extension"]:
+        lott = json.loads(card["origin_extension"]["lott"])
+        if 'lottery_time' in lott and lott["lottery_time"] <= import_once.now_time:
+            return '过期抽奖'
+    return None
+
+def _black_keywords(card: dict, origin: dict, black_matcher) -> list:
+    '''转发的原动态中包含的黑名单关键字，只用于提示，不删除动态'''
+    if origin and 'item' in origin and 'description' in origin["item"]:
+        if 'description' in card["item"]:
+            text = origin["item"]["description"]
+        elif 'content' in card["item"]:
+            text = card["item"]["content"]
+        else:
+            text = None
+        return black_matcher.findall(text)
+    return []
 
 async def clean_dynamic_task(biliapi: asyncbili,
                        task_config: dict
                        ) -> None:
-    try:
-        async for x in biliapi.getMyDynamic():
-            dyid = x["desc"]["dynamic_id"]
-            card = json.loads(x["card"])
-
-            if 'item' in card and 'miss' in card["item"] and card["item"]["miss"] == 1:
-                await biliapi.removeDynamic(dyid)
-                logging.info(f'{biliapi.name}: 已删除id为{dyid}的动态，原因为：动态已被原作者删除')
-                continue
-            
-            if 'origin_extension' in card and 'lott' in card["origin_extension"]:
-                lott = json.loads(card["origin_extension"]["lott"])
-                if 'lottery_time' in lott and lott["lottery_time"] <=  now_time:
-                    await biliapi.removeDynamic(dyid)
-                    logging.info(f'{biliapi.name}: 已删除id为{dyid}的动态，原因为：过期抽奖')
-                    continue
+    black_matcher = get_matcher(task_config["black_keywords"]) #所有账户共用编译好的黑名单关键字
+    semaphore = asyncio.Semaphore(max(1, task_config.get("concurrency", 5))) #同时查询抽奖信息的最大数量
+    interval = task_config.get("interval", 1)
+    pacer = TokenBucket(1 / interval, 1) if interval > 0 else None #本账户删除动态的速率，0为不限速
+    notices = {} #orig_dy_id->查询抽奖信息的Future，同一账户内相同的抽奖只查询一次
+    queue = asyncio.Queue() #(动态id, 删除原因)
+    checks = [] #正在进行的抽奖信息检查
+
+    async def get_notice(orig_dy_id: int) -> dict:
+        async with semaphore:
+            return (await import_once.get_lottery_notice(biliapi, orig_dy_id))["data"] #抽奖信息在所有账户间缓存
 
-            if 'item' in card and 'orig_dy_id' in card["item"]:
-                ret = (await biliapi.getLotteryNotice(card["item"]["orig_dy_id"]))["data"]
-                if 'lottery_time' in ret and ret["lottery_time"] <= now_time:
-                    await biliapi.removeDynamic(dyid)
-                    logging.info(f'{biliapi.name}: 已删除id为{dyid}的动态，原因为：过期抽奖')
+    async def check_notice(dyid: int, orig_dy_id: int) -> None:
+        if orig_dy_id not in notices:
+            notices[orig_dy_id] = asyncio.ensure_future(get_notice(orig_dy_id))
+        try:
+            ret = await asyncio.shield(notices[orig_dy_id])
+        except Exception as e:
+            logging.warning(f'{biliapi.name}: 获取id为{orig_dy_id}的抽奖信息异常，原因为{str(e)}')
+            return
+        if 'lottery_time' in ret and ret["lottery_time"] <= import_once.now_time:
+            await queue.put((dyid, '过期抽奖'))
+
+    async def produce() -> None:
+        '''扫描动态列表，本地能判断的直接放入删除队列，需要抽奖信息的并发查询'''
+        try:
+            async for x in biliapi.getMyDynamic():
+                dyid = x["desc"]["dynamic_id"]
+                card, origin = _decode(x)
+                reason = _check_local(card)
+                if reason:
+                    await queue.put((dyid, reason))
                     continue
+                keywords = _black_keywords(card, origin, black_matcher)
+                if keywords:
+                    logging.info(f'{biliapi.name}: id为{dyid}的动态包含黑名单关键字{",".join(keywords)}')
+                if 'item' in card and 'orig_dy_id' in card["item"]:
+                    checks.append(asyncio.ensure_future(check_notice(dyid, card["item"]["orig_dy_id"])))
+        except Exception as e:
+            logging.warning(f'{biliapi.name}: 获取动态列表、异常，原因为{str(e)}，跳过剩余的动态清理')
+        finally:
+            if checks:
+                await asyncio.wait(checks)
+            await queue.put(None)
+
+    async def consume() -> None:
+        '''按速率限制依次删除队列中的动态'''
+        while True:
+            item = await queue.get()
+            if item is None:
+                break
+            dyid, reason = item
+            try:
+                if pacer:
+                    await pacer.acquire()
+                ret = await biliapi.removeDynamic(dyid)
+                if ret["code"] == 0:
+                    logging.info(f'{biliapi.name}: 已删除id为{dyid}的动态，原因为：{reason}')
+                else:
+                    logging.warning(f'{biliapi.name}: 删除id为{dyid}的动态失败，信息为{ret["message"]}')
+            except Exception as e:
+                logging.warning(f'{biliapi.name}: 删除id为{dyid}的动态异常，原因为{str(e)}')
 
-            if 'origin' in card:
-                origin = json.loads(card["origin"])
-                if 'item' in origin and 'description' in origin["item"]:
-                    if 'description' in card["item"]:
-                        text = origin["item"]["description"]
-                    elif 'content' in card["item"]:
-                        text = card["item"]["content"]
-                    else:
-                        text = None
-                    if text:
-                        for x in task_config["black_keywords"]:
-                            if x in text:
-                                logging.info(f'{biliapi.name}: 已删除id为{dyid}的动态，原因为：包含黑名单关键字{x}')
-                                continue
-    except Exception as e: 
-        logging.warning(f'{biliapi.name}: 获取动态列表、异常，原因为{str(e)}，跳过动态清理')
\ No newline at end of file
+    await asyncio.gather(produce(), consume())
@@ -0,0 +1,72 @@
+import datetime
+
+BEIJING = datetime.timezone(datetime.timedelta(hours=8)) #任务时间均以北京时间计算
+
+class CronTrigger(object):
+    '''
+    cron表达式定时器，格式为"分 时 日 月 周"，支持*、逗号列表、a-b范围和/步长
+    周的取值为0-6(0为周日)，日和周同时指定时满足其一即可(与crontab相同)
+    '''
+    _ranges = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 6))
+
+    def __init__(self, expression: str):
+        fields = expression.split()
+        if len(fields) != 5:
+            raise ValueError(f'cron表达式格式错误({expression})')
+        self._expression = expression
+        self._minutes, self._hours, self._days, self._months, self._weekdays = \
+            [self._parse_field(field, low, high) for field, (low, high) in zip(fields, self._ranges)]
+        self._any_day = fields[2] == '*'
+        self._any_weekday = fields[4] == '*'
+
+    def __repr__(self):
+        return f'<CronTrigger {self._expression}>'
+
+    @staticmethod
+    def _parse_field(field: str, low: int, high: int) -> list:
+        '''解析cron表达式的一个字段，返回排好序的取值列表'''
+        values = set()
+        for part in field.split(','):
+            step = 1
+            if '/' in part:
+                part, step = part.split('/')
+                step = int(step)
+            if part == '*':
+                start, end = low, high
+            elif '-' in part:
+                start, end = [int(x) for x in part.split('-')]
+            else:
+                start = int(part)
+                end = high if step > 1 else start
+            if start < low or end > high or start > end or step < 1:
+                raise ValueError(f'cron表达式字段超出范围({field})')
+            values.update(range(start, end + 1, step))
+        return sorted(values)
+
+    def _match_day(self, day: datetime.date) -> bool:
+        if day.month not in self._months:
+            return False
+        in_days = day.day in self._days
+        in_weekdays = (day.isoweekday() % 7) in self._weekdays
+        if self._any_day:
+            return in_weekdays
+        if self._any_weekday:
+            return in_days
+        return in_days or in_weekdays
+
+    def next(self, after: float) -> float:
+        '''
+        返回after之后(不含)第一个满足表达式的时间戳
+        after float 时间戳
+        '''
+        start = datetime.datetime.fromtimestamp(after, BEIJING).replace(second=0, microsecond=0) + datetime.timedelta(minutes=1)
+        day = start.date()
+        for ii in range(366 * 5): #闰年2月29日等情况最多需要查找几年
+            if self._match_day(day):
+                for hour in self._hours:
+                    for minute in self._minutes:
+                        t = datetime.datetime(day.year, day.month, day.day, hour, minute, tzinfo=BEIJING)
+                        if t >= start:
+                            return t.timestamp()
+            day += datetime.timedelta(days=1)
+        raise ValueError(f'cron表达式没有可以触发的时间({self._expression})')
@@ -0,0 +1,42 @@
+import sqlite3, logging
+
+class DynamicStore(object):
+    '''记录每个账户动态列表处理进度和已转发动态id的本地sqlite数据库'''
+    def __init__(self, path: str):
+        '''
+        path str 数据库文件路径
+        '''
+        self._conn = sqlite3.connect(path, timeout=30) #多进程运行时等待其他进程写入
+        with self._conn:
+            self._conn.execute('CREATE TABLE IF NOT EXISTS cursor (uid INTEGER PRIMARY KEY, dynamic_id INTEGER NOT NULL)')
+            self._conn.execute('CREATE TABLE IF NOT EXISTS reposted (uid INTEGER NOT NULL, dynamic_id INTEGER NOT NULL, PRIMARY KEY (uid, dynamic_id))')
+
+    def get_cursor(self, uid: int) -> int:
+        '''取得账户上次处理到的动态id，没有记录返回0'''
+        row = self._conn.execute('SELECT dynamic_id FROM cursor WHERE uid = ?', (uid,)).fetchone()
+        return row[0] if row else 0
+
+    def set_cursor(self, uid: int, dynamic_id: int) -> None:
+        '''记录账户本次处理到的动态id'''
+        with self._conn:
+            self._conn.execute('INSERT OR REPLACE INTO cursor (uid, dynamic_id) VALUES (?, ?)', (uid, dynamic_id))
+
+    def get_reposted(self, uid: int) -> set:
+        '''取得账户转发过的所有动态id'''
+        return {row[0] for row in self._conn.execute('SELECT dynamic_id FROM reposted WHERE uid = ?', (uid,))}
+
+    def add_reposted(self, uid: int, dynamic_id: int) -> None:
+        '''记录账户转发过的动态id'''
+        with self._conn:
+            self._conn.execute('INSERT OR IGNORE INTO reposted (uid, dynamic_id) VALUES (?, ?)', (uid, dynamic_id))
+
+_stores = {}
+def get_store(path: str) -> DynamicStore:
+    '''同一个数据库文件在本进程内只打开一次，所有账户共用，打开失败时只提示一次并返回None'''
+    if path not in _stores:
+        try:
+            _stores[path] = DynamicStore(path)
+        except Exception as e:
+            _stores[path] = None
+            logging.warning(f'打开动态记录文件{path}异常，原因为{str(e)}，本次将扫描全部动态')
+    return _stores[path]
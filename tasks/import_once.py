@@ -1,13 +1,32 @@
-from BiliClient import asyncbili
+from BiliClient import asyncbili, AsyncCache
 import time
 
-ids = None
+cache = AsyncCache() #所有账户共享的缓存，只用于与账户无关的接口
+
+def _is_success(ret) -> bool:
+    '''只缓存成功的请求'''
+    return isinstance(ret, dict) and ret.get("code") == 0
+
 async def get_ids(biliapi: asyncbili):
-    '''全局单例ids，避免重复请求'''
-    global ids
-    if not ids:
-        ids = await biliapi.getRegions()
-    return ids
-
-now_time = int(time.time()) #第一次加载模块的时间
-taday = time.localtime(now_time + 28800 + time.timezone).tm_mday #今天是几号
\ No newline at end of file
+    '''所有账户共享的分区视频信息，避免重复请求'''
+    return await cache.get(('getRegions',), biliapi.getRegions, ttl=600, cache_if=_is_success)
+
+async def get_recommend_list(biliapi: asyncbili):
+    '''所有账户共享的直播首页推荐列表'''
+    return await cache.get(('xliveGetRecommendList',), biliapi.xliveGetRecommendList, ttl=300, cache_if=_is_success)
+
+async def get_room_info(biliapi: asyncbili, room_id: int):
+    '''所有账户共享的直播间信息'''
+    return await cache.get(('xliveGetRoomInfo', room_id), biliapi.xliveGetRoomInfo, room_id, ttl=600, cache_if=_is_success)
+
+async def get_lottery_notice(biliapi: asyncbili, dynamic_id: int):
+    '''所有账户共享的抽奖信息'''
+    return await cache.get(('getLotteryNotice', dynamic_id), biliapi.getLotteryNotice, dynamic_id, ttl=3600, cache_if=_is_success)
+
+def refresh_time() -> None:
+    '''刷新now_time和taday，常驻运行时每次执行任务前调用'''
+    global now_time, taday
+    now_time = int(time.time()) #本次运行开始的时间
+    taday = time.localtime(now_time + 28800 + time.timezone).tm_mday #今天是几号
+
+refresh_time()
\ No newline at end of file
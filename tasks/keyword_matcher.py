@@ -0,0 +1,35 @@
+import re
+from functools import lru_cache
+
+class KeywordMatcher(object):
+    '''把关键字列表编译为一个正则表达式，扫描一遍文本即可找出其中出现的所有关键字'''
+    def __init__(self, keywords: list):
+        self._keywords = list(dict.fromkeys(x for x in keywords if x)) #去掉重复和空的关键字
+        if self._keywords:
+            #零宽断言使每个位置都尝试匹配，长关键字优先，保证关键字互相重叠时也不会漏掉
+            pattern = '|'.join(re.escape(x) for x in sorted(self._keywords, key=len, reverse=True))
+            self._regex = re.compile(f'(?=({pattern}))')
+        else:
+            self._regex = None
+        #在同一位置开始的短关键字是匹配到的长关键字的前缀，需要一起返回
+        self._prefixes = {x: [y for y in self._keywords if y != x and x.startswith(y)] for x in self._keywords}
+
+    def findall(self, text: str) -> list:
+        '''返回text中出现的所有关键字，按首次出现的位置排序'''
+        if not self._regex or not text:
+            return []
+        found = {}
+        for match in self._regex.finditer(text):
+            keyword = match.group(1)
+            found.setdefault(keyword)
+            for prefix in self._prefixes[keyword]:
+                found.setdefault(prefix)
+        return list(found)
+
+@lru_cache(maxsize=64)
+def _compile(keywords: tuple) -> KeywordMatcher:
+    return KeywordMatcher(keywords)
+
+def get_matcher(keywords: list) -> KeywordMatcher:
+    '''相同的关键字列表只编译一次，所有账户共用'''
+    return _compile(tuple(keywords))
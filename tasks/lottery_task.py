@@ -1,73 +1,122 @@
-from BiliClient import asyncbili
-from .import_once import now_time
+from BiliClient import asyncbili, TokenBucket
+from . import import_once
+from .dynamic_store import get_store
+from .keyword_matcher import get_matcher
 import logging, json, asyncio
 
-end_time = now_time - (now_time + 28800) % 86400 + 43200 #当天中午12点
-start_time = end_time - 86400
-
 async def lottery_task(biliapi: asyncbili, 
                        task_config: dict    #配置
                        ) -> None:
 
-    already_repost_dyid = [] #记录动态列表中自己已经转发的动态id
-    try:
-        async for x in biliapi.getDynamic():
-            if x["desc"]["uid"] == biliapi.uid and x["desc"]["pre_dy_id"]: #记录本账号转发过的动态
-                already_repost_dyid.append(x["desc"]["pre_dy_id"])
-                continue
+    now_time = import_once.now_time
+    end_time = now_time - (now_time + 28800) % 86400 + 43200 #当天中午12点
+    start_time = end_time - 86400
+    matcher = get_matcher(task_config["keywords"]) #所有账户共用编译好的关键字
+    interval = task_config.get("interval", 3)
+    pacer = TokenBucket(1 / interval, 1) if interval > 0 else None #本账户转发评论的速率，0为不限速
+    store = get_store(task_config["state_file"]) if task_config.get("state_file") else None
 
-            timestamp = x["desc"]["timestamp"]
-            if(timestamp > end_time):
-                continue
-            elif(timestamp < start_time):
-                break
+    if store:
+        already_repost_dyid = store.get_reposted(biliapi.uid) #记录自己已经转发的动态id
+        cursor = store.get_cursor(biliapi.uid) #上次处理到的动态id，比它旧的动态已经处理过
+    else:
+        already_repost_dyid = set()
+        cursor = 0
+
+    def add_reposted(dyid: int) -> None:
+        if dyid in already_repost_dyid:
+            return
+        already_repost_dyid.add(dyid)
+        if store:
+            store.add_reposted(biliapi.uid, dyid)
+
+    queue = asyncio.Queue(maxsize=10) #(类型, 用户名, 动态id, 动态详情请求)，容量同时限制了提前进行的详情请求数量
+    scanned = [] #本次扫描范围内的动态id，从新到旧
+    failed = set() #转发失败的动态id
+
+    async def produce() -> bool:
+        '''扫描动态列表，把需要转发的动态放入队列并提前请求动态详情，返回是否完整扫描'''
+        try:
+            async for x in biliapi.getDynamic():
+                if x["desc"]["uid"] == biliapi.uid and x["desc"]["pre_dy_id"]: #记录本账号转发过的动态
+                    add_reposted(x["desc"]["pre_dy_id"])
+                    continue
+
+                timestamp = x["desc"]["timestamp"]
+                if(timestamp > end_time):
+                    continue
+                elif(timestamp < start_time or x["desc"]["dynamic_id"] <= cursor):
+                    break
+                scanned.append(x["desc"]["dynamic_id"])
 
-            if 'card' in x:
-                card = json.loads(x["card"])
-                if 'item' in card:
-                    flag = False
-                    if 'description' in card["item"]:
-                        text = card["item"]["description"]
-                    elif 'content' in card["item"]:
-                        text = card["item"]["content"]
-                    else:
-                        text = None
-                    if text:
-                        for keyword in task_config["keywords"]:
-                            if keyword in text:
-                                uname = x["desc"]["user_profile"]["info"]["uname"]  #动态的主人的用户名
-                                dyid = x["desc"]["dynamic_id"]
-                                if dyid in already_repost_dyid: #若动态被转发过就跳过
-                                    continue
-                                try:
-                                    await biliapi.dynamicRepostReply(dyid, task_config["repost"])
-                                    detail = await biliapi.getDynamicDetail(dyid)
-                                    oid = detail["data"]["card"]["desc"]["rid"]
-                                    await biliapi.dynamicReplyAdd(oid, task_config["reply"])
-                                    logging.info(f'{biliapi.name}: 转发评论关键字动态(用户名:{uname},动态id:{dyid})成功')
-                                except Exception as e: 
-                                    logging.warning(f'{biliapi.name}: 转发评论关键字动态(用户名:{uname},动态id:{dyid})异常，原因为{str(e)}')
-                                flag = True
-                                break
-                    if flag:
-                        await asyncio.sleep(3)
-                        continue
+                kind = None
+                if 'card' in x:
+                    card = json.loads(x["card"])
+                    if 'item' in card:
+                        if 'description' in card["item"]:
+                            text = card["item"]["description"]
+                        elif 'content' in card["item"]:
+                            text = card["item"]["content"]
+                        else:
+                            text = None
+                        keywords = matcher.findall(text)
+                        if keywords:
+                            kind = f'关键字动态(关键字:{",".join(keywords)})'
+                if not kind and 'extension' in x and 'lott' in x["extension"]: #若抽奖标签存在
+                    kind = '抽奖动态'
+                if not kind:
+                    continue
 
-            if 'extension' in x and 'lott' in x["extension"]: #若抽奖标签存在
                 uname = x["desc"]["user_profile"]["info"]["uname"]  #动态的主人的用户名
                 dyid = x["desc"]["dynamic_id"]
                 if dyid in already_repost_dyid: #若动态被转发过就跳过
                     continue
-                try:
-                    await biliapi.dynamicRepostReply(dyid, task_config["repost"]) #这里转发到自己的动态
-                    detail = await biliapi.getDynamicDetail(dyid)
-                    oid = detail["data"]["card"]["desc"]["rid"]
-                    await biliapi.dynamicReplyAdd(oid, task_config["reply"])    #这里评论
-                    logging.info(f'{biliapi.name}: 转发评论抽奖动态(用户名:{uname},动态id:{dyid})成功')
-                except Exception as e: 
-                    logging.warning(f'{biliapi.name}: 转发评论抽奖动态(用户名:{uname},动态id:{dyid})异常，原因为{str(e)}')
-                await asyncio.sleep(3)
+                await queue.put((kind, uname, dyid, asyncio.ensure_future(biliapi.getDynamicDetail(dyid))))
+        except Exception as e:
+            logging.warning(f'{biliapi.name}: 获取动态列表、异常，原因为{str(e)}，跳过剩余的抽奖动态')
+            return False
+        finally:
+            await queue.put(None)
+        return True
+
+    async def consume() -> None:
+        '''按速率限制依次转发评论队列中的动态'''
+        while True:
+            item = await queue.get()
+            if item is None:
+                break
+            kind, uname, dyid, detail = item
+            try:
+                if pacer:
+                    await pacer.acquire()
+                ret = await biliapi.dynamicRepostReply(dyid, task_config["repost"]) #这里转发到自己的动态
+                if ret["code"] != 0: #被拒绝(如-412)时不记录为已转发，下次重新处理
+                    logging.warning(f'{biliapi.name}: 转发{kind}(用户名:{uname},动态id:{dyid})失败，信息为{ret["message"]}')
+                    failed.add(dyid)
+                    detail.cancel()
+                    continue
+                add_reposted(dyid)
+                oid = (await detail)["data"]["card"]["desc"]["rid"]
+                ret = await biliapi.dynamicReplyAdd(oid, task_config["reply"])    #这里评论
+                if ret["code"] != 0:
+                    logging.warning(f'{biliapi.name}: 评论{kind}(用户名:{uname},动态id:{dyid})失败，信息为{ret["message"]}')
+                    failed.add(dyid)
+                    continue
+                logging.info(f'{biliapi.name}: 转发评论{kind}(用户名:{uname},动态id:{dyid})成功')
+            except Exception as e:
+                logging.warning(f'{biliapi.name}: 转发评论{kind}(用户名:{uname},动态id:{dyid})异常，原因为{str(e)}')
+                if dyid not in already_repost_dyid:
+                    failed.add(dyid) #没有转发成功，下次还需要处理
+                if not detail.done():
+                    detail.cancel()
+                elif not detail.cancelled():
+                    detail.exception() #转发失败时详情请求的异常不再需要
+
+    complete, _ = await asyncio.gather(produce(), consume())
 
-    except Exception as e: 
-        logging.warning(f'{biliapi.name}: 获取动态列表、异常，原因为{str(e)}，跳过转发抽奖动态')
-        return
+    if store and complete: #完整扫描并处理完队列后才更新进度，中途出错时下次重新扫描
+        if failed: #只前进到最早的失败动态之前，更新的动态下次重新处理
+            scanned = [x for x in scanned if x < min(failed)]
+        newest_dyid = max(scanned, default=cursor)
+        if newest_dyid > cursor:
+            store.set_cursor(biliapi.uid, newest_dyid)
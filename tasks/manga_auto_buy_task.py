@@ -87,7 +87,7 @@ async def manga_auto_buy_task(biliapi: asyncbili,
 
     for x in buy_list:
         try:
-            manga_detail = (await biliapi.mangaDetail(x[0]))["data"]
+            manga_detail = (await biliapi.mangaDetail(x[0]))["data"] #章节解锁状态与账户有关，不使用共享缓存
         except Exception as e: 
             logging.warning(f'{biliapi.name}: 获取mc为{x[0]} 的漫画信息失败，原因为:{str(e)}')
             continue
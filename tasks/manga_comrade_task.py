@@ -1,11 +1,11 @@
 from BiliClient import asyncbili
-from .import_once import taday
+from . import import_once
 import logging
 
 async def manga_comrade_task(biliapi: asyncbili,
                              task_config: dict
                              ) -> None:
-    if not taday in task_config["days"]:
+    if not import_once.taday in task_config["days"]:
         return
     try:
         ret = await biliapi.mangaComrade()
@@ -19,6 +19,6 @@ async def manga_comrade_task(biliapi: asyncbili,
             else:
                 logging.info(f'{biliapi.name}: 您貌似今天已经参与过站友日活动了')
         else:
-            logging.info(f'{biliapi.name}: 站友日还未启动，请看看这月{taday}号是否是站友日')
+            logging.info(f'{biliapi.name}: 站友日还未启动，请看看这月{import_once.taday}号是否是站友日')
     except Exception as e: 
         logging.warning(f'{biliapi.name}: 站友日活动参与异常,原因为：{str(e)}')
\ No newline at end of file
@@ -1,11 +1,11 @@
 from BiliClient import asyncbili
-from .import_once import taday
+from . import import_once
 import logging
 
 async def manga_vip_reward_task(biliapi: asyncbili,
                                 task_config: dict
                                 ) -> None:
-    if not taday in task_config["days"]:
+    if not import_once.taday in task_config["days"]:
         return
     try:
         ret = await biliapi.mangaGetVipReward()
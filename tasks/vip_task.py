@@ -1,9 +1,9 @@
 from BiliClient import asyncbili
-from .import_once import taday
+from . import import_once
 import logging
 
 async def vip_task(biliapi: asyncbili) -> None:
-    if taday == 1:
+    if import_once.taday == 1:
         try:
             ret = await biliapi.vipPrivilegeReceive(1)
             if ret["code"] == 0:
@@ -19,7 +19,7 @@ async def vip_task(biliapi: asyncbili) -> None:
         except:
             logging.warning('{biliapi.name}: 领取大会员权益异常')
 
-    elif taday == 28:
+    elif import_once.taday == 28:
         try:
             cbp = (await biliapi.getUserWallet())["data"]["couponBalance"] #B币劵数量
             if cbp > 0:
@@ -1,15 +1,15 @@
 from BiliClient import asyncbili
-from .import_once import now_time
+from . import import_once
 import logging
 
 async def xlive_bag_send_task(biliapi: asyncbili):
     try:
-         room_id = (await biliapi.xliveGetRecommendList())["data"]["list"][6]["roomid"]
-         uid = (await biliapi.xliveGetRoomInfo(room_id))["data"]["room_info"]["uid"]
+         room_id = (await import_once.get_recommend_list(biliapi))["data"]["list"][6]["roomid"]
+         uid = (await import_once.get_room_info(biliapi, room_id))["data"]["room_info"]["uid"]
          bagList = (await biliapi.xliveGiftBagList())["data"]["list"]
          ishave = False
          for x in bagList:
-             if x["expire_at"] - now_time < 172800: #礼物到期时间小于2天
+             if x["expire_at"] - import_once.now_time < 172800: #礼物到期时间小于2天
                  ishave = True
                  ret = await biliapi.xliveBagSend(room_id, uid, x["bag_id"], x["gift_id"], x["gift_num"])
                  if ret["code"] == 0:
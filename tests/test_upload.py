@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+import os, sys, mmap, tempfile, threading, unittest, requests
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from BiliClient import VideoUploader
+from BiliClient import Video
+
+MiB = 1048576
+
+def rssFile():
+    "当前进程映射文件占用的物理内存(字节)，不是Linux时返回None"
+    try:
+        with open('/proc/self/status', 'r') as fp:
+            for line in fp:
+                if line.startswith('RssFile:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+class FakeUploader(VideoUploader):
+    "不访问网络的上传类，记录每个分块的映射大小和同时打开的映射数量"
+    def __init__(self, chunk_size=MiB, threads=2):
+        super().__init__()
+        self.chunk_size = chunk_size
+        self.threads = threads
+        self.lock = threading.Lock()
+        self.windows = []
+        self.chunk_sizes = []
+        self.open_windows = 0
+        self.max_open = 0
+        self.peak_rss = 0
+
+    def videoPreupload(self, name, size):
+        return {"auth": "a", "endpoint": "//upos.example.com", "biz_id": 1, "upos_uri": "upos://ugc/test.mp4", "chunk_size": self.chunk_size, "threads": self.threads}
+
+    def videoUploadId(self, url, auth):
+        return {"upload_id": "id"}
+
+    def videoUpload(self, url, auth, upload_id, data, chunk, chunks, start, total):
+        with self.lock:
+            self.windows.append(len(data.obj))
+            self.chunk_sizes.append(len(data))
+            self.open_windows += 1
+            self.max_open = max(self.max_open, self.open_windows)
+        bytes(data) #读取整个分块，使映射的页面进入内存
+        rss = rssFile()
+        with self.lock:
+            self.open_windows -= 1
+            self.peak_rss = max(self.peak_rss, rss or 0)
+        return True
+
+    def videoUploadInfo(self, url, auth, parts, filename, upload_id, biz_id):
+        return {"OK": 1}
+
+def httpError(status):
+    "构造服务器返回status时videoUpload抛出的异常"
+    response = requests.Response()
+    response.status_code = status
+    return requests.HTTPError(f'{status} Error', response=response)
+
+class FailingUploader(FakeUploader):
+    "第一个上传会话的第3个分块先返回status，之后的请求都成功"
+    def __init__(self, status, **kwargs):
+        super().__init__(**kwargs)
+        self.status = status
+        self.sessions = []
+        self.failures = 0
+
+    def videoUploadId(self, url, auth):
+        self.sessions.append(f'id{len(self.sessions)}')
+        return {"upload_id": self.sessions[-1]}
+
+    def videoUpload(self, url, auth, upload_id, data, chunk, chunks, start, total):
+        if upload_id == 'id0' and chunk == 2:
+            with self.lock:
+                self.failures += 1
+                failures = self.failures
+            if self.status in (401, 403, 404) or failures == 1:
+                raise httpError(self.status)
+        return super().videoUpload(url, auth, upload_id, data, chunk, chunks, start, total)
+
+class UploadFileTest(unittest.TestCase):
+    def setUp(self):
+        Video._upload_stats.clear()
+        fd, self.path = tempfile.mkstemp(suffix='.mp4')
+        with os.fdopen(fd, 'wb') as f:
+            for ii in range(64):
+                f.write(os.urandom(MiB))
+            f.write(b'tail')
+
+    def tearDown(self):
+        for filename in (self.path, f'{self.path}.upload.json'):
+            if os.path.exists(filename):
+                os.remove(filename)
+
+    def test_map_one_window_per_chunk(self):
+        uploader = FakeUploader()
+        ret = uploader.uploadFile(self.path, threads=2, max_threads=2, resume=False)
+        self.assertEqual(ret["filename"], 'test')
+        self.assertEqual(len(uploader.windows), 65)
+        self.assertLessEqual(max(uploader.windows), MiB + mmap.ALLOCATIONGRANULARITY) #只映射一个分块
+        self.assertLessEqual(uploader.max_open, 2)
+
+    @unittest.skipIf(rssFile() is None, '需要/proc/self/status')
+    def test_rss_does_not_grow_with_file_size(self):
+        base = rssFile()
+        uploader = FakeUploader()
+        uploader.uploadFile(self.path, threads=2, max_threads=2, resume=False)
+        self.assertLess(uploader.peak_rss - base, 16 * MiB) #文件为64MiB，同时最多映射2个1MiB的分块
+
+    def test_chunk_size_adapts_across_instances(self):
+        first = FakeUploader(chunk_size=8 * MiB)
+        first.uploadFile(self.path, fsize=MiB, threads=2, resume=False) #上传很快，下次分块可以放大一倍
+        second = FakeUploader(chunk_size=8 * MiB)
+        second.uploadFile(self.path, threads=2, resume=False)
+        self.assertEqual(max(first.chunk_sizes), MiB)
+        self.assertEqual(max(second.chunk_sizes), 2 * MiB) #新对象使用上一个对象在同一服务器测得的速度，而不是服务器建议的8MiB
+
+    def test_retry_part_on_server_error(self):
+        uploader = FailingUploader(503)
+        ret = uploader.uploadFile(self.path, threads=2, retries=1)
+        self.assertEqual(ret["filename"], 'test')
+        self.assertEqual(uploader.sessions, ['id0']) #5xx只重试分块，不重新开始上传会话
+        self.assertEqual(uploader.failures, 2)
+
+    def test_restart_session_when_upload_id_rejected(self):
+        uploader = FailingUploader(404)
+        ret = uploader.uploadFile(self.path, threads=2, retries=3)
+        self.assertEqual(ret["filename"], '')
+        self.assertEqual(uploader.failures, 1) #上传id无效时不再重试
+        self.assertTrue(os.path.exists(f'{self.path}.upload.json'))
+        ret = uploader.uploadFile(self.path, threads=2, retries=3) #续传时服务器拒绝，重新申请上传
+        self.assertEqual(ret["filename"], 'test')
+        self.assertEqual(uploader.sessions, ['id0', 'id1'])
+        self.assertFalse(os.path.exists(f'{self.path}.upload.json'))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,5 +1,8 @@
-from BiliClient import VideoDownloader
-import sys, json, re
+from BiliClient import VideoDownloader, RangeDownloader, TokenBucket
+from BiliClient.aria2py import Aria2Py
+from getopt import getopt
+from aiohttp import ClientSession, ClientTimeout, TCPConnector
+import sys, os, json, re, time, asyncio
 
 ReverseProxy = 'http://biliapi.8box.top/playerproxy' #解析接口代理
 
@@ -10,40 +13,227 @@ def callback(per):
     sys.stdout.write("\rPercent: [%s] %.2f%%"%(hashes + spaces, per*100))
     sys.stdout.flush()
 
-url = input('请输入视频链接：')
-videos = VideoDownloader(url)
-print(f'当前视频标题为：{videos.getTitle()}')
-video_list = videos.all()
-if len(video_list) == 1:
-    video = video_list[0]
-else:
-    for ii in range(len(video_list)):
-        print(f'{ii+1}. {video_list[ii]}')
-    P = int(input('请输入要下载的分P序号：'))
-    video = video_list[P-1]
-
-cookie = input('是否加载账号cookie(y/n)：')
-reverse = input('是否使用内部代理(可下载港澳台)(y/n)：')
-
-if cookie.upper() == 'Y':
+def load_cookie():
+    '''读取配置文件中第一个账户的cookie'''
     with open('config/config.json','r',encoding='utf-8') as fp:
         configData = json.loads(re.sub(r'\/\*[\s\S]*?\/', '', fp.read()))
-    if reverse.upper() == 'Y':
-        video_stream_list = video.allStream(configData["users"][0]["cookieDatas"], reverse_proxy=ReverseProxy)
+    return configData["users"][0]["cookieDatas"]
+
+def interactive():
+    '''交互式下载一个分P'''
+    url = input('请输入视频链接：')
+    videos = VideoDownloader(url)
+    print(f'当前视频标题为：{videos.getTitle()}')
+    video_list = videos.all()
+    if len(video_list) == 1:
+        video = video_list[0]
     else:
-        video_stream_list = video.allStream(configData["users"][0]["cookieDatas"])
-else:
-    if reverse.upper() == 'Y':
-        video_stream_list = video.allStream(reverse_proxy=ReverseProxy)
+        for ii in range(len(video_list)):
+            print(f'{ii+1}. {video_list[ii]}')
+        P = int(input('请输入要下载的分P序号：'))
+        video = video_list[P-1]
+
+    cookie = input('是否加载账号cookie(y/n)：')
+    reverse = input('是否使用内部代理(可下载港澳台)(y/n)：')
+
+    if cookie.upper() == 'Y':
+        if reverse.upper() == 'Y':
+            video_stream_list = video.allStream(load_cookie(), reverse_proxy=ReverseProxy)
+        else:
+            video_stream_list = video.allStream(load_cookie())
     else:
-        video_stream_list = video.allStream()
-
-for ii in range(len(video_stream_list)):
-    print(f'{ii+1}. {video_stream_list[ii]}')
-print('注：登录会员账号可能获得更高清视频流！')
-P = int(input('请输入要下载的视频流序号：'))
-video_stream = video_stream_list[P-1]
-print('正在下载.....')
-video_stream.download(callback=callback)
-print('\n','结束')
-input('按任意键退出')
\ No newline at end of file
+        if reverse.upper() == 'Y':
+            video_stream_list = video.allStream(reverse_proxy=ReverseProxy)
+        else:
+            video_stream_list = video.allStream()
+
+    for ii in range(len(video_stream_list)):
+        print(f'{ii+1}. {video_stream_list[ii]}')
+    print('注：登录会员账号可能获得更高清视频流！')
+    P = int(input('请输入要下载的视频流序号：'))
+    video_stream = video_stream_list[P-1]
+    print('正在下载.....')
+    video_stream.download(callback=callback)
+    print('\n','结束')
+    input('按任意键退出')
+
+async def resolve_all(urls: list,
+                      cookieData: dict,
+                      reverse_proxy: str,
+                      dash: bool,
+                      report: list,
+                      concurrency=8
+                      ) -> list:
+    '''并发解析所有链接的所有分P，返回[(视频标题, 分P, 最高清晰度的视频流)]，失败的记录到report'''
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(concurrency) #解析接口使用同步请求，在线程池中并发
+    async def run(func, *args):
+        async with semaphore:
+            return await loop.run_in_executor(None, func, *args)
+
+    async def parts(url):
+        videos = await run(VideoDownloader, url)
+        return videos.getTitle().replace('/',' '), await run(videos.all)
+
+    result = await asyncio.gather(*[parts(url) for url in urls], return_exceptions=True)
+    video_list = []
+    for url, ret in zip(urls, result):
+        if isinstance(ret, Exception):
+            report.append((url, '解析失败', 0, 0, str(ret)))
+            continue
+        title, part_list = ret
+        video_list.extend((title, x) for x in part_list)
+
+    result = await asyncio.gather(*[run(x.allStream, cookieData, reverse_proxy, False, dash) for title, x in video_list], return_exceptions=True)
+    tasks = []
+    for (title, video), ret in zip(video_list, result):
+        if isinstance(ret, Exception) or not ret:
+            report.append((f'{title}/{video}', '解析失败', 0, 0, str(ret) if ret else '没有可下载的视频流'))
+            continue
+        tasks.append((title, video, ret[0]))
+    return tasks
+
+async def download_all(tasks: list,
+                       outdir: str,
+                       report: list,
+                       jobs=3,
+                       connections=16,
+                       bandwidth=0
+                       ) -> None:
+    '''
+    通过全局队列下载所有视频流
+    jobs int 同时下载的视频数量
+    connections int 所有下载共用的最大连接数
+    bandwidth float 所有下载共用的最大带宽(字节/秒)，0为不限速
+    '''
+    queue = asyncio.Queue()
+    for x in tasks:
+        queue.put_nowait(x)
+    bucket = TokenBucket(bandwidth, max(bandwidth / 10, 65536)) if bandwidth else None #最多突发0.1秒的流量
+    async with ClientSession(connector=TCPConnector(limit=connections), timeout=ClientTimeout(total=None, sock_read=60)) as session:
+        downloader = RangeDownloader(session=session, bucket=bucket)
+
+        async def worker():
+            while not queue.empty():
+                title, video, stream = queue.get_nowait()
+                path = os.path.join(outdir, title)
+                os.makedirs(path, exist_ok=True)
+                start = time.monotonic()
+                try:
+                    path = await stream.downloadAsync(path, downloader=downloader)
+                    report.append((f'{title}/{video}', '成功', os.path.getsize(path), time.monotonic() - start, ''))
+                    print(f'下载完成：{path}')
+                except Exception as e:
+                    report.append((f'{title}/{video}', '下载失败', 0, time.monotonic() - start, str(e)))
+                    print(f'下载失败：{title}/{video}，原因为{str(e)}')
+
+        await asyncio.gather(*[worker() for ii in range(jobs)])
+
+async def download_aria2(tasks: list,
+                         outdir: str,
+                         report: list
+                         ) -> None:
+    '''用一次请求把所有视频流添加到aria2，等待aria2通知全部结束，同时下载的数量由aria2的设置决定'''
+    loop = asyncio.get_running_loop()
+    items = []
+    for title, video, stream in tasks:
+        if not hasattr(stream, 'aria2Task'):
+            report.append((f'{title}/{video}', '下载失败', 0, 0, 'aria2不支持DASH视频流'))
+            continue
+        path = os.path.join(outdir, title)
+        os.makedirs(path, exist_ok=True)
+        items.append((title, video, stream.aria2Task(path)))
+    if not items:
+        return
+
+    start = time.monotonic()
+    aria2 = await loop.run_in_executor(None, Aria2Py)
+    ret = await loop.run_in_executor(None, aria2.addUris, [x[2][0] for x in items], [x[2][1] for x in items])
+    if 'error' in ret:
+        raise Exception(f'添加aria2任务失败({ret["error"]["message"]})')
+    gids = {}
+    for (title, video, (uri, options)), x in zip(items, ret["result"]):
+        if isinstance(x, list):
+            gids[x[0]] = (title, video, options["out"])
+        else:
+            report.append((f'{title}/{video}', '下载失败', 0, 0, f'添加aria2任务失败({x["message"]})'))
+    print(f'已添加{len(gids)}个aria2任务')
+    status = await aria2.waitForDownloads(list(gids))
+    for gid, (title, video, path) in gids.items():
+        if status[gid] == 'complete':
+            report.append((f'{title}/{video}', '成功', os.path.getsize(path), time.monotonic() - start, ''))
+        else:
+            report.append((f'{title}/{video}', '下载失败', 0, time.monotonic() - start, f'status: {status[gid]}'))
+
+def print_report(report: list, elapsed: float) -> None:
+    '''输出下载报告'''
+    print('\n下载报告：')
+    for name, status, size, seconds, error in report:
+        line = f'{status}\t{name}'
+        if size:
+            line += f'\t{size / 1048576:0.2f}MB\t{seconds:0.1f}s\t{size / 1048576 / max(seconds, 1e-6):0.2f}MB/s'
+        if error:
+            line += f'\t{error}'
+        print(line)
+    total = sum(x[2] for x in report)
+    success = sum(1 for x in report if x[1] == '成功')
+    print(f'共{len(report)}个，成功{success}个，失败{len(report) - success}个，总计{total / 1048576:0.2f}MB，用时{elapsed:0.1f}s，平均{total / 1048576 / max(elapsed, 1e-6):0.2f}MB/s')
+
+def batch(urls: list,
+          outdir='.',
+          cookie=False,
+          reverse=False,
+          dash=False,
+          jobs=3,
+          connections=16,
+          bandwidth=0,
+          aria2=False
+          ) -> None:
+    '''非交互式下载所有链接的所有分P(剧集)，aria2为True时交给aria2下载(不支持DASH)'''
+    report = []
+    start = time.monotonic()
+    async def run():
+        tasks = await resolve_all(urls, load_cookie() if cookie else None, ReverseProxy if reverse else '', dash, report)
+        print(f'共解析到{len(tasks)}个视频，开始下载')
+        if aria2:
+            await download_aria2(tasks, outdir, report)
+        else:
+            await download_all(tasks, outdir, report, jobs, connections, bandwidth)
+    asyncio.run(run())
+    print_report(report, time.monotonic() - start)
+
+if __name__ == '__main__':
+    if len(sys.argv) == 1:
+        interactive()
+        sys.exit()
+
+    kwargs = {}
+    urls = []
+    opts, args = getopt(sys.argv[1:], "hu:f:o:j:c:b:dkra",["url=","file=","outdir=","jobs=","connections=","bandwidth=","dash","cookie","reverse","aria2"])
+    for opt, arg in opts:
+        if opt in ('-u','--url'):
+            urls.append(arg)
+        elif opt in ('-f','--file'):
+            with open(arg, 'r', encoding='utf-8') as fp:
+                urls.extend(x.strip() for x in fp if x.strip())
+        elif opt in ('-o','--outdir'):
+            kwargs["outdir"] = arg
+        elif opt in ('-j','--jobs'):
+            kwargs["jobs"] = int(arg)
+        elif opt in ('-c','--connections'):
+            kwargs["connections"] = int(arg)
+        elif opt in ('-b','--bandwidth'):
+            kwargs["bandwidth"] = float(arg) * 1048576
+        elif opt in ('-d','--dash'):
+            kwargs["dash"] = True
+        elif opt in ('-k','--cookie'):
+            kwargs["cookie"] = True
+        elif opt in ('-r','--reverse'):
+            kwargs["reverse"] = True
+        elif opt in ('-a','--aria2'):
+            kwargs["aria2"] = True
+        elif opt == '-h':
+            print('videoDownloader -u <BV/av/ep/ss号或链接，可多次指定> -f <每行一个链接的文件> -o <保存目录> -j <同时下载的视频数> -c <总连接数> -b <总带宽MB/s> -d(DASH) -k(使用账号cookie) -r(使用代理) -a(使用aria2下载)')
+            sys.exit()
+    urls.extend(args)
+    batch(urls, **kwargs)
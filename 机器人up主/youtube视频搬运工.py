@@ -1,7 +1,7 @@
 # -*- coding: utf-8 -*-
 from BiliClient import VideoUploader
 import time, json, re
-from pytube import YouTube
+from pytube import YouTube, request
 
 with open('config/config.json','r',encoding='utf-8') as fp:
         configData = json.loads(re.sub(r'\/\*[\s\S]*?\/', '', fp.read()))
@@ -16,14 +16,14 @@ video = YouTube(url)
 for x in video.streams:
     print(x)
 itag = input("请输入要下载的itag(直接回车默认为22)：")
-if itag:
-    filename = video.streams.get_by_itag(int(itag)).download()
-else:
-    filename = video.streams.get_by_itag(22).download()
+stream = video.streams.get_by_itag(int(itag) if itag else 22)
+filename = stream.default_filename
 
 bilivideo = VideoUploader(configData["users"][0]["cookieDatas"]) #创建B站视频发布任务
 print(f'开始将{filename}上传至B站，请耐心等待')
-vd = bilivideo.uploadFile(filename) #上传视频
+#边从youtube下载边上传，不保存到本地
+vd = bilivideo.uploadStream(request.stream(stream.url), stream.filesize, filename, callback=lambda p, s: print(f'\r上传进度{p*100:.1f}% 速度{s/1048576:.2f}MB/s', end=''))
+print()
 if vd["filename"] == "":
     print("上传失败")
     exit(0)